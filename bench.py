@@ -0,0 +1,187 @@
+"""
+Micro-benchmarks for the performance sensitive parts of the processing pipeline.
+Each benchmark runs on synthetic data, so no OpenFOAM case is needed.
+
+Usage:
+    python bench.py mesh [--ncells 1000000]   # Face/cell center computation, loop vs. vectorized.
+    python bench.py field [--ncells 1000000]  # ASCII internalField parsing, Ofpp vs. fieldio, full and selective. Checks the results match.
+    python bench.py snapshot [--ncells 200000] [--nframes 10] # Snapshot interpolation, griddata per frame vs. cached weights. Checks the results match.
+    python bench.py render [--nframes 10]     # Frames per second writing snapshot PNGs, matplotlib figure vs. direct renderer. Checks the direct colors and orientation.
+
+Example:
+    python bench.py mesh --ncells 2000000
+"""
+import os, sys, time, argparse, tempfile
+
+parser = argparse.ArgumentParser(description="Runs micro-benchmarks on synthetic data.")
+parser.add_argument("what", help="Which benchmark to run.", choices=["mesh", "field", "snapshot", "render"])
+parser.add_argument("--ncells", type=int, help="Number of cells in the synthetic mesh.", default=200000)
+parser.add_argument("--seed",   type=int, help="Random seed.", default=0)
+parser.add_argument("--nprobes", type=int, help="Number of cells to read in the selective field benchmark.", default=500)
+parser.add_argument("--nframes", type=int, help="Number of frames in the snapshot benchmark.", default=10)
+parser.add_argument("--grid_size", type=float, help="Grid spacing in the snapshot benchmark, the mesh is the unit square.", default=0.002)
+parser.add_argument("--shape", type=str, help="Rows,columns of the snapshots in the render benchmark.", default="1500,500")
+args = parser.parse_args()
+print(args)
+
+import numpy as np
+sys.path.append(os.getenv("CFDGITPY") or os.path.dirname(os.path.abspath(__file__)))
+import openfoam
+import fieldio
+from external import Ofpp
+
+def timed(name, fun, *fargs):
+    start = time.time()
+    result = fun(*fargs)
+    elapsed = time.time() - start
+    print("{:<40s}: {:>8.3f} secs.".format(name, elapsed))
+    return result, elapsed
+
+def synthetic_mesh(ncells, rng):
+    # Hex-like topology: each cell has 6 quad faces, each face is shared by ~2 cells.
+    nfaces  = 3 * ncells
+    npoints = ncells
+    points  = rng.random((npoints, 3))
+    faces   = rng.integers(0, npoints, size=(nfaces, 4)).tolist()
+    cell_faces = rng.integers(0, nfaces, size=(ncells, 6)).tolist()
+    return points, faces, cell_faces
+
+if args.what == "mesh":
+    rng = np.random.default_rng(args.seed)
+    print("Building synthetic mesh with {} cells.".format(args.ncells))
+    points, faces, cell_faces = synthetic_mesh(args.ncells, rng)
+
+    def loop():
+        face_centers = np.array([np.mean(points[f,:],  axis=0) for f in faces])
+        cell_centers = np.array([np.mean(face_centers[c,:], axis=0) for c in cell_faces])
+        return cell_centers
+
+    def vectorized():
+        face_points, face_offsets = openfoam.lists_to_csr(faces)
+        cell_faces_flat, cell_offsets = openfoam.lists_to_csr(cell_faces)
+        face_centers = openfoam.segment_mean(points[face_points], face_offsets)
+        return openfoam.segment_mean(face_centers[cell_faces_flat], cell_offsets)
+
+    ref, t_loop = timed("loop (np.mean per face/cell)", loop)
+    new, t_vec  = timed("vectorized (CSR + reduceat)", vectorized)
+    print("Max abs difference: {:g}".format(np.max(np.abs(ref - new))))
+    print("Speedup: {:.1f}x".format(t_loop / t_vec))
+
+if args.what == "field":
+    rng = np.random.default_rng(args.seed)
+    values = rng.standard_normal((args.ncells, 3)) * 1000
+    header = "FoamFile\n{{\n    format      ascii;\n    class       {};\n}}\n\ndimensions      [0 0 0 0 0 0 0];\n\n"
+    footer = ")\n;\n\nboundaryField\n{\n    walls\n    {\n        type            zeroGradient;\n    }\n}\n"
+    contents = {
+        "uniform scalar": header.format("volScalarField") + "internalField   uniform 0.5;\n\nboundaryField\n{\n}\n",
+        "uniform vector": header.format("volVectorField") + "internalField   uniform (1 0 -2.5);\n\nboundaryField\n{\n}\n",
+        "scalar": header.format("volScalarField") + "internalField   nonuniform List<scalar> \n{}\n(\n".format(args.ncells)
+            + "\n".join("{:.6g}".format(v) for v in values[:,0]) + "\n" + footer,
+        "vector": header.format("volVectorField") + "internalField   nonuniform List<vector> \n{}\n(\n".format(args.ncells)
+            + "\n".join("({:.6g} {:.6g} {:.6g})".format(*v) for v in values) + "\n" + footer,
+    }
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, content in contents.items():
+            path = os.path.join(tmp_dir, name.replace(" ", "_"))
+            with open(path, "w") as f:
+                f.write(content)
+            mb = os.path.getsize(path) / 1e6
+            print("*"*40)
+            print("{} ({:.1f} MB)".format(name, mb))
+            ref, t_ofpp = timed("Ofpp.parse_internal_field", Ofpp.parse_internal_field, path)
+            new, t_new  = timed("fieldio.parse_internal_field", fieldio.parse_internal_field, path)
+            if not np.array_equal(np.asarray(ref), np.asarray(new)):
+                print("MISMATCH between Ofpp and fieldio for {}.".format(name))
+                exit(1)
+            print("Results match. Ofpp: {:.1f} MB/s, fieldio: {:.1f} MB/s.".format(mb / t_ofpp, mb / t_new))
+            if name.startswith("uniform"):
+                continue
+            indices = np.unique(rng.integers(0, args.ncells, size=args.nprobes))
+            sel, t_sel = timed("selective ({} cells)".format(len(indices)), fieldio.parse_internal_field, path, indices)
+            if not np.array_equal(sel, new[indices]):
+                print("MISMATCH in selective read for {}.".format(name))
+                exit(1)
+            print("Selective read: {:.1f} MB/s.".format(mb / t_sel))
+
+if args.what == "snapshot":
+    from scipy.interpolate import griddata
+    rng = np.random.default_rng(args.seed)
+    # Cell centers scattered over the unit square, so pixels near its edges are outside their convex hull.
+    centers = rng.random((args.ncells, 3))
+    mesh = openfoam.Mesh.__new__(openfoam.Mesh)
+    mesh.cell_centers = centers
+    mesh._set_ranges()
+    frames = [rng.standard_normal(len(centers)) for _ in range(args.nframes)]
+    print("{} cell centers, {} frames.".format(len(centers), len(frames)))
+
+    def per_frame():
+        XX, YY = np.meshgrid(*mesh.snapshot_grid(args.grid_size))
+        return [griddata(centers[:,:2], F, (XX,YY), method="linear") for F in frames]
+
+    def cached():
+        W, xs, ys = mesh.snapshot_weights(args.grid_size)
+        outside = np.diff(W.indptr) == 0
+        result = []
+        for F in frames:
+            FF = W @ F
+            FF[outside] = np.nan
+            result.append(FF.reshape(len(ys), len(xs)))
+        return result
+
+    ref, t_ref = timed("griddata per frame", per_frame)
+    new, t_new = timed("cached weights (incl. triangulation)", cached)
+    _,   t_hot = timed("cached weights (reused)", cached)
+    for R, N in zip(ref, new):
+        if not np.array_equal(np.isnan(R), np.isnan(N)) or np.nanmax(np.abs(R - N)) > 1e-9:
+            print("MISMATCH between griddata and the cached weights.")
+            exit(1)
+    print("Results match, {} of {} pixels outside the convex hull.".format(np.isnan(ref[0]).sum(), ref[0].size))
+    print("Per frame: griddata {:.3f} secs, cached weights {:.4f} secs. Speedup {:.1f}x.".format(t_ref / len(frames), t_hot / len(frames), t_ref / t_hot))
+
+if args.what == "render":
+    import render
+    import matplotlib as mpl
+    mpl.use("Agg")
+    from matplotlib import pyplot as plt, colormaps, colors, image as mpimg
+    rng = np.random.default_rng(args.seed)
+    ny, nx = [int(n) for n in args.shape.split(",")]
+    # Smooth fields with a NaN corner, like a snapshot with pixels outside the mesh.
+    yy, xx = np.mgrid[0:1:ny*1j, 0:1:nx*1j]
+    frames = []
+    for _ in range(args.nframes):
+        FF = np.sin(2*np.pi*(rng.random() + 3*xx)) * np.cos(2*np.pi*(rng.random() + 7*yy))
+        FF[:ny//10, :nx//10] = np.nan
+        frames.append(FF)
+    print("{} frames of {} x {}.".format(len(frames), ny, nx))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        def with_matplotlib():
+            for i, FF in enumerate(frames):
+                vmin, vmax = render.color_limits(FF, "1%", "99%")
+                plt.figure(figsize=(6,16))
+                plt.matshow(np.flipud(FF), extent=[0, 1, 0, 1], vmin = vmin, vmax = vmax, aspect="equal", fignum=0, cmap=plt.cm.gray)
+                plt.gca().axis("off")
+                plt.savefig(os.path.join(tmp_dir, "mpl{}.png".format(i)), bbox_inches="tight", pad_inches = -0.05)
+                plt.close("all")
+
+        def direct():
+            lut = render.colormap_lut("gray")
+            for i, FF in enumerate(frames):
+                render.write_png(os.path.join(tmp_dir, "direct{}.png".format(i)), render.render(FF, *render.color_limits(FF, "1%", "99%"), lut = lut))
+
+        _, t_mpl    = timed("matplotlib figure", with_matplotlib)
+        _, t_direct = timed("direct renderer", direct)
+
+        # The direct PNG must hold the matplotlib colors of the values, with the largest y in the top row.
+        FF = frames[0]
+        vmin, vmax = render.color_limits(FF, "1%", "99%")
+        expected = np.flipud(colormaps["gray"](colors.Normalize(vmin, vmax)(FF), bytes = True)[:,:,:3])
+        expected[np.flipud(np.isnan(FF))] = 255
+        written = np.round(mpimg.imread(os.path.join(tmp_dir, "direct0.png")) * 255).astype(np.uint8)
+        if written.shape != expected.shape or not np.array_equal(written, expected):
+            print("MISMATCH between the direct PNG and the colormapped values.")
+            exit(1)
+        print("Direct PNG matches the colormapped values.")
+    print("Frames per second: matplotlib {:.1f}, direct {:.1f}. Speedup {:.1f}x.".format(len(frames) / t_mpl, len(frames) / t_direct, t_mpl / t_direct))
+
+print("ALLDONE")
@@ -0,0 +1,256 @@
+"""
+Fast readers for OpenFOAM field files.
+
+parse_internal_field is a drop-in replacement for Ofpp.parse_internal_field for ASCII files:
+it locates the internalField block and converts it in bulk with NumPy instead of line by line.
+Binary files are handed over to Ofpp. Gzipped field files are decompressed in memory,
+and fields of archived time directories are streamed straight out of the tar.gz archive.
+"""
+import os, re, gzip, zlib, tarfile
+from collections import OrderedDict
+import numpy as np
+from external import Ofpp
+
+# Number of components for each OpenFOAM list type.
+NUM_COMPONENTS = {b"scalar": 1, b"vector": 3, b"symmTensor": 6, b"tensor": 9}
+
+_internal_field_re = re.compile(rb"^internalField\s+(nonuniform|uniform)\s+", re.M)
+_list_header_re    = re.compile(rb"List<(\w+)>\s*(\d+)\s*\(")
+_binary_format_re  = re.compile(rb"^\s*format\s+binary\s*;", re.M)
+_label_list_re     = re.compile(rb"^(\d+)\s*\(", re.M)
+_list_end_re       = re.compile(rb"\)\s*(?://[^\n]*\s*)*\Z") # The closing parenthesis, then only whitespace and // comments.
+
+# Errors raised when reading a truncated or corrupted (compressed) file.
+READ_ERRORS = (OSError, EOFError, zlib.error, tarfile.TarError)
+
+def is_binary_format(content, header_bytes = 2048):
+    return _binary_format_re.search(content, 0, header_bytes) is not None
+
+def parse_uniform(content, start):
+    """
+    Parses the value of a uniform field starting at start, e.g. '0;' or '(0 0 0);'.
+    Returns a float or a 1D array, like Ofpp does.
+    """
+    value = content[start:content.index(b";", start)].strip()
+    if value.startswith(b"("):
+        return np.array(value[1:-1].split(), dtype=float)
+    return float(value)
+
+def find_nonuniform_list(content, start):
+    """
+    Locates the nonuniform list that starts at or after start.
+    Returns (num_components, num_values, data_start, data_end) where content[data_start:data_end]
+    holds the entries without the enclosing parentheses.
+    """
+    m = _list_header_re.match(content, start)
+    if m is None:
+        raise ValueError("Could not find a 'List<type> N (' header.")
+    if m.group(1) not in NUM_COMPONENTS:
+        raise ValueError("Unsupported list type {}.".format(m.group(1).decode()))
+    ncomp, num = NUM_COMPONENTS[m.group(1)], int(m.group(2))
+    data_start = m.end()
+    if ncomp == 1:
+        data_end = content.index(b")", data_start)
+    else:
+        # Each entry is closed by one ')', the list by the next one.
+        closes   = np.flatnonzero(np.frombuffer(content, dtype=np.uint8, offset=data_start) == ord(")"))
+        data_end = data_start + closes[num]
+    return ncomp, num, data_start, data_end
+
+def parse_values(block, ncomp, num):
+    """
+    Converts the text of a list block into an array of num values with ncomp components.
+    Returns None if the block doesn't hold exactly num*ncomp numbers.
+    """
+    if ncomp > 1:
+        block = block.translate(None, b"()")
+    try:
+        values = np.fromstring(block, sep=" ") if block.strip() else np.zeros(0)
+    except ValueError: # Unparseable entries, older NumPy versions warn and truncate instead.
+        return None
+    if len(values) != num * ncomp:
+        return None
+    return values if ncomp == 1 else values.reshape((num, ncomp))
+
+def line_offsets(block):
+    """
+    Line index of a list block: the offsets of the newlines in block, found with one vectorized scan.
+    Entry i of a list written one entry per line is block[offsets[i]+1:offsets[i+1]].
+    """
+    return np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == ord("\n"))
+
+def parse_selected_values(block, ncomp, num, indices):
+    """
+    Like parse_values, but only converts the entries at the (sorted) indices.
+    Uses the line index of the block to jump straight to the requested entries. Lists that 
+    are not written one entry per line (e.g. short inline lists) are parsed in full instead.
+    """
+    offsets = line_offsets(block)
+    if len(offsets) != num + 1:
+        values = parse_values(block, ncomp, num)
+        return None if values is None else values[indices]
+    starts, ends = offsets[indices] + 1, offsets[indices + 1]
+    selected = b"\n".join([block[i:j] for i, j in zip(starts, ends)])
+    return parse_values(selected, ncomp, len(indices))
+
+def parse_internal_field_content(content, indices = None):
+    """
+    Parses the internal field from the raw bytes of a field file.
+    Returns an array for nonuniform fields, a float or 1D array for uniform ones,
+    and None if the internal field can't be found or is corrupted.
+    If a sorted array of cell indices is given, only those entries are converted and
+    an array with one row per index is returned, for uniform fields too.
+    """
+    m = _internal_field_re.search(content)
+    if m is None:
+        return None
+    if m.group(1) == b"uniform":
+        value = parse_uniform(content, m.end())
+        if indices is None:
+            return value
+        return np.full(len(indices), value) if np.ndim(value) == 0 else np.tile(value, (len(indices), 1))
+    if is_binary_format(content):
+        values = Ofpp.parse_internal_field_content(content.splitlines(True))
+        return values if indices is None or values is None else values[indices]
+    try:
+        ncomp, num, data_start, data_end = find_nonuniform_list(content, m.end())
+        if indices is not None and len(indices) and indices[-1] >= num:
+            raise IndexError("Index {} out of range for a list of {} values.".format(indices[-1], num))
+    except (ValueError, IndexError):
+        return None
+    if indices is None:
+        return parse_values(content[data_start:data_end], ncomp, num)
+    return parse_selected_values(content[data_start:data_end], ncomp, num, np.asarray(indices))
+
+def find_field_file(time_dir, field):
+    """
+    Returns the path of field in time_dir, either raw or gzipped, or None if neither exists.
+    """
+    for path in [os.path.join(time_dir, field), os.path.join(time_dir, field + ".gz")]:
+        if os.path.isfile(path):
+            return path
+    return None
+
+def read_bytes(path):
+    """
+    Reads the content of a field file. Files ending in .gz are decompressed in memory.
+    """
+    if path.endswith(".gz"):
+        with gzip.open(path, "rb") as f:
+            return f.read()
+    with open(path, "rb") as f:
+        return f.read()
+
+def parse_internal_field(path, indices = None):
+    """
+    Drop-in replacement for Ofpp.parse_internal_field that also reads .gz files.
+    Returns None if the file is missing or can't be read.
+    If indices are given only those entries are converted, see parse_internal_field_content.
+    """
+    if not os.path.exists(path):
+        print("Can not open file " + path)
+        return None
+    try:
+        content = read_bytes(path)
+    except READ_ERRORS as e: # e.g. a truncated .gz left behind by a killed job.
+        print("Could not read file {}: {}".format(path, e))
+        return None
+    return parse_internal_field_content(content, indices)
+
+def parse_label_list(path):
+    """
+    Parses a labelList file such as constant/polyMesh/cellProcAddressing into an integer array.
+    ASCII and binary files are supported, raw or gzipped. The label size of binary files (32 or 
+    64 bit, depending on WM_LABEL_SIZE) is worked out from the size of the list.
+    Returns None if the list can't be found or is truncated.
+    """
+    content = read_bytes(path)
+    m = _label_list_re.search(content)
+    if m is None:
+        return None
+    num = int(m.group(1))
+    if is_binary_format(content):
+        end = _list_end_re.search(content, m.end())
+        if end is None or end.start() < m.end() + 4*num:
+            return None
+        if num == 0:
+            return np.zeros(0, dtype=np.int64)
+        size = (end.start() - m.end()) / num
+        if size not in (4, 8):
+            raise ValueError("Binary label list {} holds {} bytes for {} labels, expected 4 or 8 bytes per label.".format(path, end.start() - m.end(), num))
+        return np.frombuffer(content, dtype=np.int32 if size == 4 else np.int64, count=num, offset=m.end()).astype(np.int64)
+    try:
+        labels = np.fromstring(content[m.end():content.index(b")", m.end())], dtype=np.int64, sep=" ")
+    except ValueError:
+        return None
+    return labels if len(labels) == num else None
+
+def read_archived_fields(archive, time_dir, fields):
+    """
+    Streams through the tar.gz archive of time_dir (as written by ziptimes.py) and returns a dict
+    mapping each of the fields found to the content of its file. Members can be raw or gzipped
+    field files. Nothing is extracted to disk, and reading stops once all the fields have been found.
+    """
+    wanted = {}
+    for f in fields:
+        wanted[os.path.join(time_dir, f)] = f
+        wanted[os.path.join(time_dir, f + ".gz")] = f
+    found = {}
+    with tarfile.open(archive, "r|gz") as tar:
+        for member in tar:
+            name = os.path.normpath(member.name)
+            if name in wanted and wanted[name] not in found:
+                content = tar.extractfile(member).read()
+                found[wanted[name]] = gzip.decompress(content) if name.endswith(".gz") else content
+                if len(found) == len(fields):
+                    break
+    return found
+
+class FieldCache:
+    """
+    Memory-bounded LRU cache of parsed fields. Keys are (field, time dir, file mtime), so a field 
+    file that is rewritten on disk is parsed again. The least recently used fields are evicted 
+    once the total size of the cached arrays exceeds max_bytes. The cache keeps its own copies of 
+    the arrays put in it and hands out copies, so callers can modify what they get.
+    """
+    def __init__(self, max_bytes = 2**30):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits   = 0
+        self.misses = 0
+        self._items = OrderedDict()
+
+    def get(self, key):
+        if key in self._items:
+            self._items.move_to_end(key)
+            self.hits += 1
+            value = self._items[key]
+            return value.copy() if isinstance(value, np.ndarray) else value
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        if value is None:
+            return
+        size = np.asarray(value).nbytes
+        if size > self.max_bytes:
+            return
+        if isinstance(value, np.ndarray):
+            value = value.copy()
+        if key in self._items:
+            self.nbytes -= np.asarray(self._items.pop(key)).nbytes
+        self._items[key] = value
+        self.nbytes += size
+        while self.nbytes > self.max_bytes:
+            _, evicted = self._items.popitem(last = False)
+            self.nbytes -= np.asarray(evicted).nbytes
+
+    def clear(self):
+        self._items.clear()
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __str__(self):
+        return "FieldCache: {} fields, {:.1f}/{:.1f} MB, {} hits, {} misses.".format(len(self), self.nbytes/1e6, self.max_bytes/1e6, self.hits, self.misses)
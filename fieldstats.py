@@ -28,7 +28,7 @@ with openfoam.TimedBlock("FIELDSTATS"):
     t = np.max(openfoam.Case.get_output_times()[0]) if args.time <= 0 else args.time
     print(f"Computing stats for t ~= {t}")
 
-    OF = openfoam.Case(mesh = openfoam.Mesh("mesh.p") if os.path.isfile("mesh.p") else None)
+    OF = openfoam.Case() # Loads the mesh cache, (re)building it if needed.
     
     field_name = args.fieldname
     if field_name not in OF.field_names:
@@ -0,0 +1,208 @@
+"""
+Columnar binary store of the fields of a case.
+
+Each field is kept in one preallocated (n_times, n_cells[, ncomp]) .npy array that is memory-mapped
+when read, so reading a field at a time point is a row lookup and reading a probe over time is
+a strided slice, instead of parsing one ASCII file per time directory.
+
+Layout of the store directory (by default <case>/fieldstore):
+    meta.json           Store version, number of cells, time directories and the stored fields.
+    times.npy           Time values, one per row.
+    <field>.npy         The field data, one row per time.
+    <field>.written.npy Whether each row has been filled in yet, so conversions can be resumed.
+    <field>.source.npy  The modification time (ns) and size of the field file each row was read from.
+
+Usage (from inside a case folder):
+    python fieldstore.py S1,U [--dtype float64] [--tmin 0] [--tmax 100000]
+
+Case picks the store up automatically and falls back to the field files for anything not in it.
+Rows whose field file has been rewritten since they were stored are treated as missing too. Rows
+whose field file has since been archived or deleted are still used, the store then holds the only
+uncompressed copy. Fields are stored as float64 by default, so reading them from the store gives
+the same values as parsing the files; --dtype float32 halves the size at the cost of precision.
+"""
+import os, sys, json
+from glob import glob
+import numpy as np
+from numpy.lib.format import open_memmap
+import fieldio
+
+FIELD_STORE_DIR     = "fieldstore"
+FIELD_STORE_VERSION = 2
+
+# Source stamp of rows read from a time whose field file doesn't exist, e.g. an archived one.
+NO_SOURCE = (0, -1)
+
+def source_stamp(case_path, tdir, field):
+    """
+    The (modification time in ns, size) of the field file of field in time directory tdir, raw or 
+    gzipped. For decomposed cases the files of all the processors are combined, using the latest 
+    modification time and the total size. Returns NO_SOURCE if there is no field file.
+    """
+    path  = fieldio.find_field_file(os.path.join(case_path, tdir), field)
+    files = [path] if path else [fieldio.find_field_file(d, field) for d in glob(os.path.join(case_path, "processor*", tdir))]
+    if not files or None in files:
+        return NO_SOURCE
+    stats = [os.stat(f) for f in files]
+    return (max(st.st_mtime_ns for st in stats), sum(st.st_size for st in stats))
+
+class FieldStore:
+    def __init__(self, path, case_path = None):
+        """
+        Opens the store at path, holding the fields of the case at case_path (by default the 
+        directory containing the store). Arrays are memory-mapped read-only until write is called.
+        """
+        self.path = path
+        self.case_path = case_path if case_path is not None else os.path.dirname(os.path.abspath(path))
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            meta = json.load(f)
+        if meta.get("version") != FIELD_STORE_VERSION:
+            raise ValueError("Field store {} has version {}, expected {}.".format(path, meta.get("version"), FIELD_STORE_VERSION))
+        self.n_cells   = meta["n_cells"]
+        self.fields    = meta["fields"] # Maps field names to their number of components.
+        self.time_dirs = meta["time_dirs"]
+        self.time_vals = np.load(os.path.join(path, "times.npy"))
+        self.time_index = {d:i for i, d in enumerate(self.time_dirs)}
+        self._data     = {}
+        self._written  = {}
+        self._source   = {}
+
+    @classmethod
+    def create(cls, path, time_vals, time_dirs, n_cells, field_ndims, dtype = "float64", case_path = None):
+        """
+        Creates a store at path for the given times and fields, preallocating the arrays.
+        field_ndims maps field names to their number of components, as in Case.field_ndims.
+        """
+        os.makedirs(path, exist_ok = True)
+        np.save(os.path.join(path, "times.npy"), np.asarray(time_vals, dtype=float))
+        for field, ndims in field_ndims.items():
+            shape = (len(time_dirs), n_cells) if ndims == 1 else (len(time_dirs), n_cells, ndims)
+            open_memmap(os.path.join(path, field + ".npy"), mode="w+", dtype=dtype, shape=shape).flush()
+            open_memmap(os.path.join(path, field + ".written.npy"), mode="w+", dtype=bool, shape=(len(time_dirs),)).flush()
+            open_memmap(os.path.join(path, field + ".source.npy"), mode="w+", dtype=np.int64, shape=(len(time_dirs), 2)).flush()
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump({"version": FIELD_STORE_VERSION, "n_cells": n_cells, "fields": field_ndims, "time_dirs": list(time_dirs)}, f, indent=4)
+        return cls(path, case_path)
+
+    def data(self, field, mode = "r"):
+        if field not in self._data or (mode == "r+" and self._data[field].mode != "r+"):
+            self._data[field]    = np.load(os.path.join(self.path, field + ".npy"), mmap_mode = mode)
+            self._written[field] = np.load(os.path.join(self.path, field + ".written.npy"), mmap_mode = mode)
+            self._source[field]  = np.load(os.path.join(self.path, field + ".source.npy"), mmap_mode = mode)
+        return self._data[field]
+
+    def written(self, field):
+        self.data(field)
+        return self._written[field]
+
+    def source_stamp(self, field, tdir):
+        return source_stamp(self.case_path, tdir, field)
+
+    def has(self, field, tdir):
+        """
+        Whether field at tdir is in the store and up to date with its field file.
+        """
+        if not (field in self.fields and tdir in self.time_index and bool(self.written(field)[self.time_index[tdir]])):
+            return False
+        stamp = self.source_stamp(field, tdir)
+        return stamp == NO_SOURCE or stamp == tuple(self._source[field][self.time_index[tdir]])
+
+    def has_all(self, field, tdirs):
+        return field in self.fields and all(self.has(field, d) for d in tdirs)
+
+    def read(self, field, tdir, indices = None):
+        """
+        Returns the field at time directory tdir, optionally only at the cell indices, as an
+        ordinary array rather than a read-only view of the memory-mapped store.
+        """
+        row = self.data(field)[self.time_index[tdir]]
+        return np.array(row) if indices is None else row[indices]
+
+    def probe(self, field, indices, tdirs):
+        """
+        Returns the field at the cell indices for each of the time directories, as an (n_times, n_indices[, ncomp]) array.
+        """
+        rows = [self.time_index[d] for d in tdirs]
+        # Both axes are indexed together, so only the requested values are read, not whole rows.
+        return np.asarray(self.data(field)[np.ix_(rows, np.asarray(indices))])
+
+    def write(self, field, tdir, values, stamp = None):
+        """
+        Stores values as field at tdir. stamp is the source_stamp of the field file the values were 
+        read from, taken before reading it so a file rewritten meanwhile is seen as stale.
+        """
+        i = self.time_index[tdir]
+        self.data(field, mode = "r+")[i] = values
+        self._source[field][i] = stamp if stamp is not None else self.source_stamp(field, tdir)
+        self._written[field][i] = True
+
+    def flush(self):
+        for field in self._data:
+            if self._data[field].mode == "r+":
+                self._data[field].flush()
+                self._source[field].flush()
+                self._written[field].flush()
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Converts the time directories of the current case into a columnar binary field store. Can be rerun to resume an interrupted conversion.")
+    parser.add_argument("fields",  type=str, help="Comma separated list of fields to convert, e.g. 'S1,U'.")
+    parser.add_argument("--dtype", type=str, help="Data type to store the fields as.", choices=["float32", "float64"], default="float64")
+    parser.add_argument("--tmin",  type=float, help="Minimum time to convert.", default=-1)
+    parser.add_argument("--tmax",  type=float, help="Maximum time to convert.", default=100000)
+    parser.add_argument("--rebuild", action="store_true", help="Delete and recreate the store if it already exists.")
+    args = parser.parse_args()
+    print(args)
+
+    sys.path.append(os.getenv("CFDGITPY") or os.path.dirname(os.path.abspath(__file__)))
+    import shutil
+    import openfoam
+    from utils import TimedBlock
+
+    with TimedBlock("FIELDSTORE"):
+        OF = openfoam.Case(use_field_store = False, field_cache_bytes = 0)
+        fields = args.fields.split(",")
+        for f in fields:
+            if f not in OF.field_names:
+                print("Specified field named '{}' not found.".format(f))
+                print("Available fields: {}".format(", ".join(OF.field_names)))
+                exit(1)
+
+        store_path = os.path.join(OF.path, FIELD_STORE_DIR)
+        use = [(v, d) for v, d in zip(OF.time_vals, OF.time_dirs) if args.tmin <= v <= args.tmax]
+        if os.path.isdir(store_path) and not args.rebuild:
+            try:
+                store = FieldStore(store_path)
+            except ValueError as e:
+                print("{} Rerun with --rebuild.".format(e))
+                exit(1)
+            if store.time_dirs != [d for v, d in use] or any(f not in store.fields for f in fields) or store.n_cells != len(OF.mesh.cell_centers):
+                print("Existing store {} has different times, fields or cells. Rerun with --rebuild.".format(store_path))
+                exit(1)
+            print("Resuming conversion into existing store {}.".format(store_path))
+        else:
+            shutil.rmtree(store_path, ignore_errors = True)
+            store = FieldStore.create(store_path, [v for v, d in use], [d for v, d in use], len(OF.mesh.cell_centers), {f:OF.field_ndims[f] for f in fields}, dtype = args.dtype, case_path = OF.path)
+            print("Created store {} for {} fields at {} time points.".format(store_path, len(fields), len(use)))
+
+        bad_dirs = []
+        for i, (tv, tdir) in enumerate(use):
+            todo = [f for f in fields if not store.has(f, tdir)]
+            if not todo:
+                continue
+            stamps = {f:store.source_stamp(f, tdir) for f in todo}
+            field_data, errors = OF._read_fields(tdir, todo)
+            for f in todo:
+                if f in errors:
+                    print("Warning: " + errors[f])
+                    bad_dirs.append(tdir)
+                else:
+                    store.write(f, tdir, field_data[f], stamps[f])
+            if i % 100 == 0:
+                print("Converted {:>6d}/{:>6d} time points. Latest directory: {}".format(i+1, len(use), tdir))
+                store.flush()
+        store.flush()
+        bad_dirs = list(dict.fromkeys(bad_dirs))
+        print("Done converting. {} bad time directories: {}".format(len(bad_dirs), ", ".join(bad_dirs)))
+
+    print("ALLDONE")
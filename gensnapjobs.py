@@ -12,26 +12,30 @@ parser.add_argument("--noaxis", help="Whether to hide the axes in the plots.", d
 parser.add_argument("--nperjob", help="Number of snapshots per job.", type = int, default = 10)
 parser.add_argument("--cmap", help="Colormap to use.", type=str, default="gray")
 parser.add_argument("--dim", help="The dimension to use.", type=int, default=0)
+parser.add_argument("--renderer", help="Renderer passed to ofsnapshot.py: matplotlib (default), direct or auto.", type=str, choices=["auto", "direct", "matplotlib"], default="matplotlib")
+parser.add_argument("--workers", help="Number of processes each job creates its snapshots with. Each job asks for this many cpus.", type=int, default=1)
+parser.add_argument("--mem", help="Memory to request per job. The workers share the mesh and interpolation weights, so it doesn't need to grow with --workers.", type=str, default="16G")
 args = parser.parse_args()
 
 sys.path.append(os.getenv("CFDGITPY"))
-from utils import get_numerical_directories
+import openfoam
 from functools import reduce
 
 header = """#!/bin/bash
 # Simple SLURM sbatch example
 #SBATCH --job-name=JOBNAME
 #SBATCH --ntasks=1
+#SBATCH --cpus-per-task=WORKERS
 #SBATCH --time=24:00:00
-#SBATCH --mem-per-cpu=16G
+#SBATCH --mem=MEM
 #SBATCH --partition=cpu
 
 ml purge > /dev/null 2>&1
 conda activate py36
-python -u $CFDGITPY/ofsnapshot.py FIELD NOAXIS --vmin VMIN --vmax VMAX --times TIMES --dpi DPI --cmap CMAP --dim DIM
+python -u $CFDGITPY/ofsnapshot.py FIELD NOAXIS --vmin VMIN --vmax VMAX --times TIMES --dpi DPI --cmap CMAP --dim DIM --renderer RENDERER --workers WORKERS
 """.replace("VMIN", args.vmin).replace("VMAX", args.vmax).replace("NOAXIS", "--noaxis" if args.noaxis else "")
 
-time_vals, time_dirs = get_numerical_directories()
+time_vals, time_dirs = openfoam.Case.get_output_times() # Archived times, and the times of decomposed cases, can be snapshotted directly.
 vd = sorted(zip(time_vals, time_dirs), key = lambda x: x[0])
 for i, (tv, td) in enumerate(vd):
     if tv > 0:
@@ -63,6 +67,9 @@ for i, job in enumerate(jobs):
                           ("DPI",     str(args.dpi)),
                           ("CMAP", args.cmap),
                           ("DIM", str(args.dim)),
+                          ("WORKERS", str(args.workers)),
+                          ("RENDERER", args.renderer),
+                          ("MEM", args.mem),
                           ("TIMES", ",".join(map(str, job_times)))], 
                          header)
         out_file.write(content)
@@ -1,5 +1,7 @@
 import os, sys
 import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 parser = argparse.ArgumentParser(description="Snapshot the specified field and produce an image. Run from inside a case folder.")
 parser.add_argument("fieldname", help="The name of the field to use.")
@@ -12,11 +14,16 @@ parser.add_argument("--times",  help="Specific time points to plot, given as a c
 parser.add_argument("--dpi",  help="Figure dots per inch. Defaults to -1 (use the figure default).", type=int, default=-1)
 parser.add_argument("--cmap",  help="Colormap to use.", type=str, default="jet")
 parser.add_argument("--dim",  help="The dimension to plot (for vector fields).", type=int, default=0)
+parser.add_argument("--renderer", help="How to draw PNGs. 'direct' maps the values through the colormap and writes one pixel per grid point (--scale x --scale with --scale), without axes and without matplotlib figures. 'auto' uses it for PNGs with --noaxis and no --dpi, and matplotlib otherwise. Default = matplotlib.", choices=["auto", "direct", "matplotlib"], default="matplotlib")
+parser.add_argument("--workers", help="Number of processes creating snapshots in parallel. The mesh and interpolation weights are loaded once and shared with them.", type=int, default=1)
+parser.add_argument("--scale", help="Size in pixels of each grid point for the direct renderer. --dpi is ignored by it.", type=int, default=1)
 args = parser.parse_args()
 
 sys.path.append(os.getenv("CFDGITPY"))
 from external import Ofpp
 import openfoam as openfoam
+import fieldio
+import render
 from datetime import datetime
 
 if len(sys.argv)<=1:
@@ -27,7 +34,7 @@ if len(sys.argv)<=1:
     exit()
 
 with openfoam.TimedBlock("SNAPSHOT_MAIN"):
-    OF = openfoam.Case(mesh = openfoam.Mesh("mesh.p") if os.path.isfile("mesh.p") else None)
+    OF = openfoam.Case() # Loads the mesh cache, (re)building it if needed.
     
     field_name = args.fieldname
     if field_name not in OF.field_names:
@@ -39,10 +46,19 @@ with openfoam.TimedBlock("SNAPSHOT_MAIN"):
     print("Output format: {}".format(args.extension))
 
     make_image = True
+    direct = args.renderer == "direct" or (args.renderer == "auto" and args.noaxis and args.extension == "png" and args.dpi <= 0)
     if args.extension == "p":
         print("Outputting values not an image.")
         make_image = False
         import pickle
+    elif direct:
+        if args.extension != "png":
+            print("The direct renderer only writes PNGs, can't write {} files.".format(args.extension))
+            exit(1)
+        if args.dpi > 0:
+            print("Warning: --dpi {} is ignored by the direct renderer, use --scale to set the image size.".format(args.dpi))
+        print(f"Outputting an image with the direct renderer. Using {args.vmin=} and {args.vmax=} and {args.scale=} and {args.cmap=}")
+        lut = render.colormap_lut(args.cmap)
     else:
         print(f"Outputting an image. Using {args.vmin=} and {args.vmax=} and {args.dpi=} and {args.cmap=}")
         import matplotlib as mpl
@@ -61,44 +77,73 @@ with openfoam.TimedBlock("SNAPSHOT_MAIN"):
         print("Creating snapshots for ALL time points.")
         time_vals = OF.time_vals
 
+    def snapshot(t):
+        """
+        Writes the snapshot at time t and returns its file name. Run in the worker processes if --workers > 1.
+        """
+        file_name = "{}_d{}_{:07.3f}".format(field_name, args.dim, t)
+        file_name = file_name.replace(".", "") + "." + args.extension # Don't keep the decimal, it causes problems when making movies.
+
+        if make_image and direct:
+            FF,*_ = OF.snapshot_field(field_name, t)
+            FF = FF if len(FF.shape)==2 else FF[:,:,args.dim]
+            render.write_png(file_name, render.render(FF, *render.color_limits(FF, args.vmin, args.vmax), lut = lut, scale = args.scale))
+        elif make_image:
+            
+            plt.figure(figsize=(6,16))                
+            OF.plot_field(field_name, t, vmin=args.vmin, vmax=args.vmax, cmap = args.cmap, dim=args.dim)
+            if args.noaxis:
+                plt.gca().axis("off")
+                plt.gca().xaxis.set_major_locator(NullLocator())
+                plt.gca().yaxis.set_major_locator(NullLocator())
+                if args.dpi>0:
+                    plt.savefig(file_name, bbox_inches="tight", pad_inches = -0.05, dpi=args.dpi)
+                else:
+                    plt.savefig(file_name, bbox_inches="tight", pad_inches = -0.05)
+            else:
+                if args.dpi>0:
+                    plt.savefig(file_name, bbox_inches="tight", dpi=args.dpi)
+                else:
+                    plt.savefig(file_name, bbox_inches="tight")
+            plt.close("all")
+        else:
+            FF,*_ = OF.snapshot_field(field_name, t)
+            FF = FF if len(FF.shape)==2 else FF[:,:,args.dim]
+            with open(file_name, "wb") as f:
+                pickle.dump(FF, f)
+        return file_name
+
+    def init_worker():
+        OF.verbosity   = 0 # Keeps the log of the frames from interleaving.
+        OF.field_cache = fieldio.FieldCache(0) # Each frame reads its time once, so caching would only hold memory in every worker.
+
     with openfoam.TimedBlock("CREATING SNAPSHOTS"):
         print("Creating snapshots for times {} - {} ({} snapshots).".format(time_vals[0], time_vals[-1], len(time_vals)))
         print("Using dimension {}".format(args.dim))        
-        for t in time_vals:
-            if t == 0:
-                print("Skipping 0")
-                continue
+        if 0 in time_vals:
+            print("Skipping 0")
+        time_vals = [t for t in time_vals if t != 0]
+        if args.noaxis and make_image and not direct:
+            print("Ploting with no axes.")
 
-            print(t,)
-            file_name = "{}_d{}_{:07.3f}".format(field_name, args.dim, t)
-            file_name = file_name.replace(".", "") + "." + args.extension # Don't keep the decimal, it causes problems when making movies.
-
-            if make_image:
-                
-                plt.figure(figsize=(6,16))                
-                OF.plot_field(field_name, t, vmin=args.vmin, vmax=args.vmax, cmap = args.cmap, dim=args.dim)
-                if args.noaxis:
-                    print("Ploting with no axes.")
-                    plt.gca().axis("off")
-                    plt.gca().xaxis.set_major_locator(NullLocator())
-                    plt.gca().yaxis.set_major_locator(NullLocator())
-                    if args.dpi>0:
-                        plt.savefig(file_name, bbox_inches="tight", pad_inches = -0.05, dpi=args.dpi)
-                    else:
-                        plt.savefig(file_name, bbox_inches="tight", pad_inches = -0.05)
-                else:
-                    if args.dpi>0:
-                        plt.savefig(file_name, bbox_inches="tight", dpi=args.dpi)
-                    else:
-                        plt.savefig(file_name, bbox_inches="tight")
-                plt.close("all")
-            else:
-                FF,*_ = OF.snapshot_field(field_name, t)
-                FF = FF if len(FF.shape)==2 else FF[:,:,args.dim]
-                with open(file_name, "wb") as f:
-                    pickle.dump(FF, f)
-                
-            print(f"Wrote {file_name=}")
+        # Computed (or loaded from the mesh cache) once, before forking, so the workers share the mesh and weights.
+        OF.mesh.snapshot_weights()
+        context = multiprocessing.get_context("fork") if "fork" in multiprocessing.get_all_start_methods() else None
+        if args.workers > 1 and context is None:
+            print("Can't fork worker processes on this platform, creating the snapshots serially.")
+        if args.workers > 1 and context is not None:
+            print("Creating snapshots with {} worker processes.".format(args.workers))
+            executor = ProcessPoolExecutor(args.workers, mp_context = context, initializer = init_worker)
+            # Frames are handed out one at a time as workers become free, and the results come back in time order.
+            file_names = executor.map(snapshot, time_vals)
+        else:
+            executor   = None
+            file_names = map(snapshot, time_vals)
+        try:
+            for t, file_name in zip(time_vals, file_names):
+                print(f"{t}: Wrote {file_name=}")
+        finally:
+            executor is not None and executor.shutdown()
                 
 print("ALLDONE")
 
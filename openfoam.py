@@ -1,17 +1,26 @@
 import os, sys, re, pdb
+import json, shutil, hashlib
+from itertools import chain
 from external import Ofpp
 import numpy as np
 from collections import namedtuple
 from scipy.interpolate import griddata
+from scipy.spatial import cKDTree, Delaunay
+from scipy import sparse
 from matplotlib import pyplot as plt
 import time
 from datetime import datetime
 import pickle
-from copy import deepcopy
+from copy import copy, deepcopy
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import argparse
 import pdb
 
-from utils import TimedBlock, get_numerical_directories
+from utils import TimedBlock, get_numerical_directories, get_time_sources, parallel_map
+import fieldio
+import render
+from fieldstore import FieldStore, FIELD_STORE_DIR
 
 def run_case(case_root, mesh_file, solver_name):
     """
@@ -69,24 +78,127 @@ def fix_polyMesh_boundary_file(items, case_root = ".", create_backup = True):
 def coord2str(x,y,z):
     return "({:.3f}, {:.3f}, {:.3f})".format(x,y,z) if z else "({:.3f}, {:.3f})".format(x,y)
 
+def lists_to_csr(lists):
+    """
+    Flattens a list of index lists (e.g. Ofpp's faces) into CSR-style arrays.
+    Returns (indices, offsets) where the i'th list is indices[offsets[i]:offsets[i+1]].
+    """
+    counts  = np.fromiter(map(len, lists), dtype=np.int64, count=len(lists))
+    offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    indices = np.fromiter(chain.from_iterable(lists), dtype=np.int64, count=offsets[-1])
+    return indices, offsets
+
+def cell_faces_from_owner_neighbour(owner, neighbour, num_cells):
+    """
+    Builds the CSR cell -> face arrays directly from the owner and neighbour lists.
+    Only the first len(owner) - (number of boundary faces) entries of neighbour are used, 
+    so Ofpp's neighbour list (which is padded with negative boundary ids) can be passed as is.
+    """
+    owner     = np.asarray(owner, dtype=np.int64)
+    neighbour = np.asarray(neighbour, dtype=np.int64)[:len(owner)]
+    internal  = np.flatnonzero(neighbour >= 0)
+    cells   = np.concatenate([owner, neighbour[internal]])
+    faces   = np.concatenate([np.arange(len(owner), dtype=np.int64), internal])
+    order   = np.argsort(cells, kind="stable")
+    offsets = np.zeros(num_cells + 1, dtype=np.int64)
+    np.cumsum(np.bincount(cells, minlength=num_cells), out=offsets[1:])
+    return faces[order], offsets
+
+def segment_mean(values, offsets):
+    """
+    Mean of values over each CSR segment [offsets[i], offsets[i+1]).
+    Segments must be non-empty, which is always the case for faces and cells of a valid mesh.
+    """
+    counts = np.diff(offsets)
+    return np.add.reduceat(values, offsets[:-1], axis=0) / counts[:, np.newaxis]
+
+# Mesh cache layout: one .npy per array plus meta.json. Bump the version whenever the layout changes.
+MESH_CACHE_DIR     = "mesh.cache"
+MESH_CACHE_VERSION = 2
+MESH_CACHE_ARRAYS  = ["points", "face_points", "face_offsets", "cell_faces", "cell_offsets", "face_centers", "cell_centers", "proc_cells", "proc_offsets"]
+# Snapshot interpolation weights are saved in the mesh cache directory, one file per grid.
+SNAPSHOT_WEIGHTS_PREFIX = "snapshot_weights_"
+
+def processor_dirs(case_path = "."):
+    """
+    Returns the processorN directories of a decomposed case, sorted by N.
+    """
+    dirs = [d for d in next(os.walk(case_path))[1] if re.match(r"processor[0-9]+$", d)]
+    return sorted(dirs, key = lambda d: int(d[len("processor"):]))
+
+def is_decomposed(case_path = "."):
+    """
+    A case is read as decomposed if it has processor directories but no reconstructed mesh.
+    """
+    mesh_dir = os.path.join(case_path, "constant", "polyMesh")
+    reconstructed = any(os.path.isfile(os.path.join(mesh_dir, f)) for f in ["faces", "faces.gz"])
+    return not reconstructed and len(processor_dirs(case_path)) > 0
+
+def polymesh_fingerprint(case_path = "."):
+    """
+    Fingerprint of the files in constant/polyMesh, based on their names, sizes and modification times.
+    For decomposed cases the polyMesh directories of all the processors are used.
+    """
+    mesh_dirs = [os.path.join(p, "constant", "polyMesh") for p in processor_dirs(case_path)] if is_decomposed(case_path) else [os.path.join("constant", "polyMesh")]
+    h = hashlib.sha1()
+    for mesh_dir in mesh_dirs:
+        for f in sorted(os.listdir(os.path.join(case_path, mesh_dir))):
+            st = os.stat(os.path.join(case_path, mesh_dir, f))
+            h.update("{}:{}:{}\n".format(os.path.join(mesh_dir, f), st.st_size, st.st_mtime_ns).encode())
+    return h.hexdigest()
+
+def _read_processor_mesh(proc_path):
+    """
+    Reads the cell centers and cellProcAddressing of one processor of a decomposed case.
+    Defined at module level so that it can be run in a process pool.
+    """
+    mesh = Mesh(proc_path, use_cache = False) # Only the case's own cache is kept.
+    addressing_file = fieldio.find_field_file(os.path.join(proc_path, "constant", "polyMesh"), "cellProcAddressing")
+    if addressing_file is None:
+        raise FileNotFoundError("Could not find cellProcAddressing for {}.".format(proc_path))
+    addressing = fieldio.parse_label_list(addressing_file)
+    if addressing is None or len(addressing) != len(mesh.cell_centers):
+        raise ValueError("Could not read cellProcAddressing for {}, or it doesn't match its mesh.".format(proc_path))
+    return np.asarray(mesh.cell_centers), addressing
+
+# The case read by the worker processes of Case.read_probes, set by _init_probe_worker.
+_probe_worker_case = None
+
+def _init_probe_worker(case):
+    global _probe_worker_case
+    _probe_worker_case = case
+
+def _read_probe_chunk(job):
+    return _probe_worker_case._read_probe_chunk(*job)
+
+def _parse_field_job(job):
+    # (path, indices) -> field data, for reading the processors of a decomposed case in a process pool.
+    return fieldio.parse_internal_field(*job)
+
 class Mesh:
     def log(self, msg):
         print(msg)
 
-    def __init__(self, path):
+    def __init__(self, path, use_cache = True, workers = 1):
+        """
+        Reads the mesh of the case at path, or a pickled Mesh if path is a file.
+        For case directories the mesh is loaded from the binary cache in MESH_CACHE_DIR
+        if it's there and up to date, otherwise it's read from constant/polyMesh and the cache is (re)written.
+        Decomposed cases are read from their processor directories, using workers processes.
+        """
         with TimedBlock("LOADING MESH FROM {}".format(path), self.log):
             if os.path.isdir(path):
                 self.log("Specified path is a directory, assuming it's an OpenFOAM case root and reading the mesh from it.")
-                self.log("Reading mesh from '%s'." % path)
-                self.path = path            
-                self.mesh = Ofpp.FoamMesh(self.path)
-                self.log("%d faces found. Computing face centers..." % (len(self.mesh.faces)))
-                self.face_centers = np.array([np.mean(self.mesh.points[f,:],  axis=0) for f in self.mesh.faces])
-                self.log("%d cells found. Computing cell centers..." % (len(self.mesh.cell_faces)))
-                self.cell_centers = np.array([np.mean(self.face_centers[c,:], axis=0) for c in self.mesh.cell_faces])
-                self.x_range = (min(self.cell_centers[:,0]), max(self.cell_centers[:,0]))
-                self.y_range = (min(self.cell_centers[:,1]), max(self.cell_centers[:,1]))
-                self.z_range = (min(self.cell_centers[:,2]), max(self.cell_centers[:,2]))        
+                self.path = path
+                cache_path  = os.path.join(path, MESH_CACHE_DIR)
+                self.fingerprint = fingerprint = polymesh_fingerprint(path)
+                if not (use_cache and self.load_cache(cache_path, fingerprint)):
+                    if is_decomposed(path):
+                        self._read_decomposed(path, workers)
+                    else:
+                        self._read_polymesh(path)
+                    use_cache and self.save_cache(cache_path, fingerprint)
                 self.log("X range: {}.".format(self.x_range))
                 self.log("Y range: {}.".format(self.y_range))
                 self.log("Z range: {}.".format(self.z_range))
@@ -95,27 +207,233 @@ class Mesh:
                 self.load_from_file(path)
             else:
                 raise ValueError("Specified path is neither a file nor a directory, don't know what to do!")
-    
-    def coord2index(self, x, y, z = None):
-        self.log("Mapping coordinates to data index.")
-        d2 = (x - self.cell_centers[:,0])**2 + (y - self.cell_centers[:,1])**2
-        if z:
-            d2 += (z - self.cell_centers[:,2])**2
-        ind = np.argmin(d2)
-        self.log("Desired coordinates: {}.".format(coord2str(x,y,z)))
-        self.log("Closest cell center: {}.".format(coord2str(*tuple(self.cell_centers[ind,:]))))
-        self.log("Index %d." % (ind))
+
+    def _read_polymesh(self, path):
+        self.log("Reading mesh from '%s'." % path)
+        foam_mesh = Ofpp.FoamMesh(path)
+        self.points = np.asarray(foam_mesh.points, dtype=float)
+        # Faces and cells are stored CSR-style: flat index arrays plus offsets.
+        self.face_points, self.face_offsets = lists_to_csr(foam_mesh.faces)
+        self.cell_faces,  self.cell_offsets = cell_faces_from_owner_neighbour(foam_mesh.owner, foam_mesh.neighbour, foam_mesh.num_cell)
+        self.log("%d faces found. Computing face centers..." % (len(self.face_offsets) - 1))
+        self.face_centers = segment_mean(self.points[self.face_points], self.face_offsets)
+        self.log("%d cells found. Computing cell centers..." % (len(self.cell_offsets) - 1))
+        self.cell_centers = segment_mean(self.face_centers[self.cell_faces], self.cell_offsets)
+        self._set_ranges()
+        self.processors = []
+
+    def _read_decomposed(self, path, workers = 1):
+        """
+        Reads a decomposed case: the mesh of each processor is read (in parallel if workers > 1),
+        and the cell centers are scattered into global cell order using cellProcAddressing.
+        Only the cell centers and the processor addressing are kept, stored CSR-style in 
+        proc_cells and proc_offsets: the global indices of the cells of processor i are 
+        proc_cells[proc_offsets[i]:proc_offsets[i+1]].
+        """
+        self.processors = processor_dirs(path)
+        self.log("Case is decomposed into {} processors, reading their meshes.".format(len(self.processors)))
+        results = parallel_map(_read_processor_mesh, [os.path.join(path, p) for p in self.processors], workers)
+        self.proc_cells, self.proc_offsets = lists_to_csr([addressing for _, addressing in results])
+        n_cells = len(self.proc_cells)
+        if not np.array_equal(np.bincount(self.proc_cells, minlength = n_cells), np.ones(n_cells)):
+            raise ValueError("The cellProcAddressing of the processors of {} don't cover each cell exactly once.".format(path))
+        self.cell_centers = np.zeros((n_cells, 3))
+        for (centers, addressing) in results:
+            self.cell_centers[addressing] = centers
+        self.log("%d cells found in %d processors." % (n_cells, len(self.processors)))
+        self._set_ranges()
+
+    def _set_ranges(self):
+        cmin, cmax = self.cell_centers.min(axis=0), self.cell_centers.max(axis=0)
+        self.x_range = (float(cmin[0]), float(cmax[0]))
+        self.y_range = (float(cmin[1]), float(cmax[1]))
+        self.z_range = (float(cmin[2]), float(cmax[2]))
+
+    def global_to_local(self, indices):
+        """
+        For a decomposed mesh, maps the global cell indices to processors. Returns a list with one 
+        (positions, local_indices) pair per processor, where indices[positions] are the cells on 
+        that processor and local_indices their (sorted) indices in the processor's fields.
+        """
+        if "_cell_processor" not in self.__dict__:
+            counts = np.diff(self.proc_offsets)
+            self._cell_processor = np.empty(len(self.proc_cells), dtype=np.int64)
+            self._cell_local     = np.empty(len(self.proc_cells), dtype=np.int64)
+            self._cell_processor[self.proc_cells] = np.repeat(np.arange(len(counts)), counts)
+            self._cell_local[self.proc_cells]     = np.arange(len(self.proc_cells)) - np.repeat(self.proc_offsets[:-1], counts)
+        indices = np.asarray(indices)
+        result  = []
+        for i in range(len(self.processors)):
+            positions = np.flatnonzero(self._cell_processor[indices] == i)
+            local     = self._cell_local[indices[positions]]
+            order     = np.argsort(local)
+            result.append((positions[order], local[order]))
+        return result
+
+    def spatial_index(self, ndims = 2):
+        """
+        Returns a KD-tree over the cell centers, using x,y if ndims == 2 and x,y,z if ndims == 3.
+        The tree is built the first time it's requested and reused afterwards.
+        """
+        trees = self.__dict__.setdefault("_trees", {})
+        if ndims not in trees:
+            with TimedBlock("Building {}D spatial index over {} cell centers.".format(ndims, len(self.cell_centers)), self.log):
+                trees[ndims] = cKDTree(self.cell_centers[:,:ndims])
+        return trees[ndims]
+
+    def coords2indices(self, coords):
+        """
+        Maps an (N, 2) or (N, 3) array of coordinates to the indices of the nearest cell centers.
+        2D coordinates ignore the z-coordinate of the cell centers.
+        """
+        coords = np.atleast_2d(np.asarray(coords, dtype=float))
+        ndims  = coords.shape[1]
+        # Coordinates on cell boundaries are equidistant from several centers. Take a few
+        # candidates and break ties on the lowest index, like the brute force argmin did.
+        k = min(2**ndims, len(self.cell_centers))
+        _, cand = self.spatial_index(ndims).query(coords, k=k)
+        cand = np.sort(cand.reshape(len(coords), k), axis=1)
+        d2   = np.sum((self.cell_centers[cand,:ndims] - coords[:,np.newaxis,:])**2, axis=2)
+        ind  = cand[np.arange(len(coords)), np.argmin(d2, axis=1)]
+        self.log("Mapped {} coordinates to data indices.".format(len(coords)))
         return ind
 
+    def coord2index(self, x, y, z = None):
+        return self.coords2indices([[x, y, z]] if z else [[x, y]])[0]
+
+    def interpolation_weights(self, coords, k = None, power = 2):
+        """
+        Inverse distance weights of the k cell centers nearest to each of an (N, 2) or (N, 3) array
+        of coordinates, as a sparse (N, n_cells) matrix whose rows sum to 1. Applying it to a field 
+        interpolates the field at all the coordinates in one sparse mat-vec. Coordinates that lie on 
+        a cell center take the value there. k defaults to 4 in 2D and 8 in 3D.
+        2D coordinates ignore the z-coordinate of the cell centers.
+        """
+        coords = np.atleast_2d(np.asarray(coords, dtype=float))
+        ndims  = coords.shape[1]
+        k = min(k if k else 2**ndims, len(self.cell_centers))
+        dist, cand = self.spatial_index(ndims).query(coords, k=k)
+        dist, cand = dist.reshape(len(coords), k), cand.reshape(len(coords), k)
+        with np.errstate(divide="ignore"):
+            w = 1. / dist**power
+        on_center = np.isinf(w)
+        w[on_center.any(axis=1)] = on_center[on_center.any(axis=1)]
+        w /= w.sum(axis=1, keepdims=True)
+        self.log("Computed interpolation weights for {} coordinates from {} cells each.".format(len(coords), k))
+        return sparse.csr_matrix((w.ravel(), (np.repeat(np.arange(len(coords)), k), cand.ravel())), shape=(len(coords), len(self.cell_centers)))
+
+    def snapshot_grid(self, grid_size = 0.001, extent = None):
+        """
+        Returns the x and y values of a snapshot grid with spacing grid_size over 
+        extent = (xmin, xmax, ymin, ymax), the range of the cell centers by default.
+        """
+        xmin, xmax, ymin, ymax = extent if extent else self.x_range + self.y_range
+        return np.arange(xmin, xmax, grid_size), np.arange(ymin, ymax, grid_size)
+
+    def snapshot_weights(self, grid_size = 0.001, extent = None):
+        """
+        Linear interpolation weights from the cell centers to the pixels of the snapshot grid (see 
+        snapshot_grid), as a sparse (n_pixels, n_cells) matrix, plus the x and y values of the grid.
+        Pixels are in the row-major order of np.meshgrid(xs, ys). Each row holds the barycentric 
+        coordinates of the pixel in the Delaunay triangle of the cell centers containing it, so 
+        applying the matrix to a field gives what griddata(..., method="linear") would. Rows of pixels 
+        outside the convex hull of the cell centers are empty.
+        The triangulation is done once per grid: the weights are kept in memory and saved in the mesh 
+        cache directory, so later frames and jobs only do a sparse mat-vec.
+        """
+        xs, ys = self.snapshot_grid(grid_size, extent)
+        key = hashlib.sha1(json.dumps([getattr(self, "fingerprint", None), len(self.cell_centers), len(xs), len(ys), float(xs[0]), float(ys[0]), float(grid_size)]).encode()).hexdigest()
+        weights = self.__dict__.setdefault("_snapshot_weights", {})
+        if key in weights:
+            return weights[key]
+        cache_dir  = os.path.join(self.path, MESH_CACHE_DIR) if getattr(self, "fingerprint", None) else None
+        cache_file = os.path.join(cache_dir, SNAPSHOT_WEIGHTS_PREFIX + key + ".npz") if cache_dir else None
+        if cache_file and os.path.isfile(cache_file):
+            with TimedBlock("Loading snapshot weights from {}.".format(cache_file), self.log):
+                with np.load(cache_file) as f:
+                    W = sparse.csr_matrix((f["data"], f["indices"], f["indptr"]), shape = tuple(f["shape"]))
+        else:
+            with TimedBlock("Computing snapshot weights for a {} x {} grid from {} cell centers.".format(len(xs), len(ys), len(self.cell_centers)), self.log):
+                XX, YY  = np.meshgrid(xs, ys)
+                pixels  = np.column_stack([XX.ravel(), YY.ravel()])
+                tri     = Delaunay(self.cell_centers[:,:2])
+                simplex = tri.find_simplex(pixels)
+                inside  = np.flatnonzero(simplex >= 0)
+                T = tri.transform[simplex[inside]]
+                b = np.einsum("nij,nj->ni", T[:,:2,:], pixels[inside] - T[:,2,:])
+                b = np.column_stack([b, 1 - b.sum(axis=1)])
+                W = sparse.csr_matrix((b.ravel(), (np.repeat(inside, 3), tri.simplices[simplex[inside]].ravel())), shape = (len(pixels), len(self.cell_centers)))
+            if cache_dir and os.path.isdir(cache_dir):
+                tmp_file = "{}.tmp{}.npz".format(cache_file[:-len(".npz")], os.getpid())
+                try:
+                    np.savez(tmp_file, data = W.data, indices = W.indices, indptr = W.indptr, shape = W.shape)
+                    os.replace(tmp_file, cache_file)
+                    self.log("Saved snapshot weights to {}.".format(cache_file))
+                except OSError as e:
+                    self.log("Warning: Could not write snapshot weights {}: {}".format(cache_file, e))
+        weights[key] = (W, xs, ys)
+        return weights[key]
+
+    def save_cache(self, path, fingerprint):
+        """
+        Writes the mesh arrays as .npy files in the directory path, plus a meta.json with the 
+        cache version and the polyMesh fingerprint. The cache is written to a temporary directory 
+        first and then renamed, so concurrent jobs never see a half written cache.
+        """
+        with TimedBlock("Saving mesh cache to {}.".format(path), self.log):
+            tmp_path = "{}.tmp{}".format(path, os.getpid())
+            try:
+                os.makedirs(tmp_path, exist_ok = True)
+                arrays = [name for name in MESH_CACHE_ARRAYS if getattr(self, name, None) is not None]
+                for name in arrays:
+                    np.save(os.path.join(tmp_path, name + ".npy"), getattr(self, name))
+                meta = {"version": MESH_CACHE_VERSION, "fingerprint": fingerprint, "arrays": arrays, "processors": self.processors,
+                        "x_range": self.x_range, "y_range": self.y_range, "z_range": self.z_range}
+                with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+                    json.dump(meta, f, indent=4)
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                os.rename(tmp_path, path)
+            except OSError as e:
+                self.log("Warning: Could not write mesh cache {}: {}".format(path, e))
+                shutil.rmtree(tmp_path, ignore_errors = True)
+
+    def load_cache(self, path, fingerprint = None):
+        """
+        Loads the mesh from the cache directory path, memory-mapping the arrays.
+        Returns False if there is no cache, or if it has the wrong version or a different fingerprint.
+        """
+        meta_file = os.path.join(path, "meta.json")
+        if not os.path.isfile(meta_file):
+            self.log("No mesh cache found at {}.".format(path))
+            return False
+        with open(meta_file, "r") as f:
+            meta = json.load(f)
+        if meta.get("version") != MESH_CACHE_VERSION:
+            self.log("Mesh cache {} has version {}, expected {}. Rebuilding it.".format(path, meta.get("version"), MESH_CACHE_VERSION))
+            return False
+        if fingerprint is not None and meta.get("fingerprint") != fingerprint:
+            self.log("Mesh cache {} is stale, polyMesh has changed. Rebuilding it.".format(path))
+            return False
+        with TimedBlock("Loading mesh cache from {}.".format(path), self.log):
+            for name in meta["arrays"]:
+                setattr(self, name, np.load(os.path.join(path, name + ".npy"), mmap_mode = "r"))
+            self.processors = meta["processors"]
+            self.x_range = tuple(meta["x_range"])
+            self.y_range = tuple(meta["y_range"])
+            self.z_range = tuple(meta["z_range"])
+        return True
+
     def save_to_file(self, path):
         with TimedBlock("Saving Mesh to file {}.".format(path), self.log):
             with open(path, "wb") as f:
-                pickle.dump(self.__dict__, f, pickle.HIGHEST_PROTOCOL)
+                pickle.dump({k:v for k,v in self.__dict__.items() if k not in ["_trees", "_snapshot_weights"]}, f, pickle.HIGHEST_PROTOCOL)
 
     def load_from_file(self, path):
         with TimedBlock("Loading mesh from file {}.".format(path), self.log):
             with open(path, "rb") as f:
                 d = pickle.load(f)
+                self.processors = []
                 self.__dict__.update(d)
         
 
@@ -123,27 +441,37 @@ class Probe:
     def log(self, msg):
         print(msg)
 
-    def __init__(self, case, field, coord,  coord_mode = "relative", name = None, color = None):
-        self.log("\nINITIALIZING NEW PROBE.")
+    def __init__(self, case, field, coord,  coord_mode = "relative", name = None, color = None, index = None, interpolate = False, weights = None, verbose = True):
+        verbose and self.log("\nINITIALIZING NEW PROBE.")
         self.name  = name  if name  else "%s_%d" % (field, sum([p.field == field for p in case.probes]) + 1)
         self.color = color if color else plt.cm.hsv(np.random.rand())
         self.coord = list(coord)
         if coord_mode.lower() == "relative":
-            self.log("Mapping relative coordinates to absolute.")
+            verbose and self.log("Mapping relative coordinates to absolute.")
             self.coord[0] = coord[0]*(case.mesh.x_range[1] - case.mesh.x_range[0]) + case.mesh.x_range[0]
             self.coord[1] = coord[1]*(case.mesh.y_range[1] - case.mesh.y_range[0]) + case.mesh.y_range[0]
             self.coord[2] = coord[2]*(case.mesh.z_range[1] - case.mesh.z_range[0]) + case.mesh.z_range[0]
         self.coord = tuple(self.coord)
-        self.index = case.mesh.coord2index(*self.coord)
+        self.index = case.mesh.coord2index(*self.coord) if index is None else index
+        # The probe value is the weighted sum of the field at cells: a single 1 at the nearest 
+        # cell center, or the interpolation weights of the neighbouring cells.
+        if weights is None and interpolate:
+            W = case.mesh.interpolation_weights([self.coord[:2]])
+            weights = (W.indices, W.data)
+        self.cells, self.weights = (np.array([self.index]), np.array([1.])) if weights is None else (np.asarray(weights[0]), np.asarray(weights[1]))
         self.field = field
-        self.data  = []
-        self.t     = []
+        self.probe_set = None # Set by ProbeSet, which holds the data of the probe.
+        self.column    = None
         self.case = case
+        if not verbose: # e.g. when adding many probes with Case.add_probes.
+            return
         self.log("    Name: %s" % (self.name))
         self.log("   Color: {}".format(self.color))
         self.log("   Field: %s" % (self.field))
         self.log("   Coord: {}".format(self.coord))
         self.log("   Index: %d" % (self.index))
+        if len(self.cells) > 1:
+            self.log(" Weights: interpolated from cells {}".format(self.cells))
         self.log("    Case: %s" % (self.case.name))
 
     def __str__(self):
@@ -161,22 +489,99 @@ class Probe:
     def __repr__(self):
         return self.__str__()
 
+    @property
+    def data(self):
+        """
+        The (n_times, ndim) data of the probe, a view into the buffer of its ProbeSet.
+        """
+        return self.probe_set.data[:, self.column] if self.probe_set is not None else []
+
+    @property
+    def t(self):
+        return self.probe_set.t if self.probe_set is not None else []
+
+class ProbeSet:
+    """
+    The probes of one field, read together. Holds the indices, coordinates, names and weights of 
+    the probes, and their data in one contiguous (n_times, n_probes, ndim) buffer. The data and t
+    of each Probe are views into the set.
+    """
+    def __init__(self, field, probes, ndim):
+        self.field   = field
+        self.probes  = list(probes)
+        self.ndim    = ndim
+        self.names   = [p.name for p in self.probes]
+        self.coords  = np.array([p.coord for p in self.probes])
+        self.indices = np.array([p.index for p in self.probes])
+        # The weights of the probes are stacked into a sparse (n_probes, n_cells) matrix over the 
+        # sorted cells the field is read at.
+        cells   = np.concatenate([p.cells for p in self.probes])
+        weights = np.concatenate([p.weights for p in self.probes])
+        indptr  = np.concatenate([[0], np.cumsum([len(p.cells) for p in self.probes])])
+        self.cells   = np.unique(cells)
+        self.weights = sparse.csr_matrix((weights, np.searchsorted(self.cells, cells), indptr), shape=(len(self.probes), len(self.cells)))
+        # If every probe takes the value at its nearest cell, its column of the values is read directly.
+        nearest = len(cells) == len(self.probes) and np.all(weights == 1)
+        self.rows = self.weights.indices if nearest else None
+        self.allocate([])
+        for i, p in enumerate(self.probes):
+            p.probe_set, p.column = self, i
+
+    def __len__(self):
+        return len(self.probes)
+
+    def allocate(self, t):
+        self.t    = list(t)
+        self.data = np.full((len(self.t), len(self.probes), self.ndim), np.nan)
+
+    def fill(self, values, i0 = 0):
+        """
+        Sets the data of the time points starting at i0 from an (n_times, n_cells[, ncomp]) array of 
+        the field values at self.cells: a single fancy-indexing operation if all the probes take the 
+        value at their nearest cell, and a single sparse mat-vec for interpolating probes.
+        """
+        n = values.shape[0]
+        values = values.reshape((n, len(self.cells), -1))
+        if self.rows is not None:
+            self.data[i0:i0 + n] = values[:, self.rows]
+        else:
+            probe_values = self.weights @ values.transpose(1, 0, 2).reshape((len(self.cells), -1))
+            self.data[i0:i0 + n] = probe_values.reshape((len(self.probes), n, -1)).transpose(1, 0, 2)
+
+
+# Default byte budget of the parsed field cache of a Case.
+FIELD_CACHE_BYTES = 2**30
 
 class Case:
     @classmethod
     def get_output_times(cls, case_path = "."):
-        return get_numerical_directories(case_path = case_path)
+        """
+        Returns the output time values and time directory names, including times 
+        that are only available as <time>.tar.gz archives. Decomposed cases are
+        read from their first processor directory, like Case does.
+        """
+        if is_decomposed(case_path):
+            return get_numerical_directories(case_path = os.path.join(case_path, processor_dirs(case_path)[0]))
+        return get_time_sources(case_path = case_path)[:2]
             
-    def __init__(self, name = None, case_path = ".", num_dims = 2, mesh = None, verbosity = 1):
+    def __init__(self, name = None, case_path = ".", num_dims = 2, mesh = None, verbosity = 1, field_cache_bytes = FIELD_CACHE_BYTES, use_field_store = True, workers = 1):
+        """
+        workers is the number of processes used to read the processors of decomposed cases in parallel.
+        """
         self.name = name if name else os.path.basename(os.path.abspath(case_path))
         self.path = case_path
         self.verbosity = verbosity
         self.num_dims = num_dims
+        self.workers = workers
+        self._executor = None
+        self._probe_pool = None # (workers, executor) reading probe chunks, see _probe_executor.
         self.probes = []
+        self.probe_sets = {} # Field name -> ProbeSet, set up by read_probes.
+        self.field_cache = fieldio.FieldCache(field_cache_bytes)
         with TimedBlock("Initializing %dD OpenFOAMCase called '%s' located at '%s'." % (self.num_dims, self.name, self.path), self.log):
 
             if mesh:
-                if type(mesh) in [str, unicode]:
+                if isinstance(mesh, str):
                     self.log("Constructing mesh from path {}".format(mesh))
                     self.mesh = Mesh(mesh)
                 else:
@@ -187,6 +592,7 @@ class Case:
                 self._read_mesh()
             self._read_output_times()
             self._read_field_names()
+            self._open_field_store(use_field_store)
             self.log("DONE loading case.")
     
 
@@ -195,20 +601,29 @@ class Case:
 
     def _read_output_times(self):
         self.log("LOADING TIMES.")
-        self.time_vals, self.time_dirs = Case.get_output_times(self.path)
+        if self.mesh.processors:
+            self.log("Case is decomposed, reading times from {}.".format(self.mesh.processors[0]))
+            self.time_vals, self.time_dirs = get_numerical_directories(case_path = os.path.join(self.path, self.mesh.processors[0]))
+            self.time_archives = {}
+        else:
+            self.time_vals, self.time_dirs, self.time_archives = get_time_sources(case_path = self.path)
         self.log("%d time points found, from %6.3f - %6.3f." % (len(self.time_dirs), min(self.time_vals), max(self.time_vals)))
+        if self.time_archives:
+            self.log("%d time points are only available as archives, their fields will be read from the archives." % (len(self.time_archives)))
         self.log("Temporal resolution: %6.3f +/- %6.3f sec." % (np.mean(np.diff(self.time_vals)), np.std(np.diff(self.time_vals))))
 
     def _read_field_names(self):
         self.log("READING FIELD NAMES.")
         self.field_names = []
         self.field_ndims = {}
-        for f in os.listdir(os.path.join(self.path, "0")):
-            if f.endswith(".gz"):
-                raise ValueError("Found zipped file {}. Ensure that all field files in the '0' folder are unzipped.".format(f))
-            
-            with open(os.path.join(self.path, "0", f), "r") as fp:
-                content = fp.read()
+        zero_dir = os.path.join(self.path, "0")
+        if self.mesh.processors and not os.path.isdir(zero_dir):
+            zero_dir = os.path.join(self.path, self.mesh.processors[0], "0")
+        for f in os.listdir(zero_dir):
+            content = fieldio.read_bytes(os.path.join(zero_dir, f)).decode("utf-8", errors="replace")
+            f = f[:-len(".gz")] if f.endswith(".gz") else f
+            if f in self.field_ndims: # Both the raw and the zipped file are there.
+                continue
             if "volScalarField" in content:
                 self.field_names.append(f)
                 self.field_ndims[f] = 1
@@ -219,13 +634,95 @@ class Case:
                 self.log("Could not determine dimensionality in file %s." % (f))
         self.log("%d fields found: %s" % (len(self.field_names), ", ".join(["%s (%dD)" % (f, self.field_ndims[f]) for f in self.field_names])))
 
+    def _open_field_store(self, use_field_store):
+        self.field_store = None
+        store_path = os.path.join(self.path, FIELD_STORE_DIR)
+        if use_field_store and os.path.isdir(store_path):
+            try:
+                store = FieldStore(store_path, self.path)
+            except ValueError as e:
+                self.log("Warning: Ignoring field store {}: {} Rebuild it with fieldstore.py --rebuild.".format(store_path, e))
+                return
+            if store.n_cells != len(self.mesh.cell_centers):
+                self.log("Warning: Ignoring field store {} because it has {} cells and the mesh has {}.".format(store_path, store.n_cells, len(self.mesh.cell_centers)))
+            else:
+                self.field_store = store
+                self.log("Using field store {} for fields {} at {} time points.".format(store_path, ", ".join(store.fields), len(store.time_dirs)))
+
     def _read_mesh(self):
-        self.mesh = Mesh(self.path)
+        self.mesh = Mesh(self.path, workers = self.workers)
+
+    def _map(self, fun, items):
+        """
+        Maps fun over items, using a process pool that is kept for the lifetime of the Case if workers > 1.
+        """
+        if self.workers <= 1:
+            return list(map(fun, items))
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(self.workers)
+        return list(self._executor.map(fun, items))
 
-    def add_probe(self, field, coord, name = None, color = None, coord_mode = "relative", min_distance = 0.01):
+    def _probe_executor(self, workers):
+        """
+        The pool of worker processes reading probe chunks. It's created on first use and kept for 
+        the lifetime of the Case, so repeated read_probes calls (e.g. one per checkpoint) reuse it.
+        Forked workers share the mesh and the rest of the case with this process without copying it.
+        """
+        if self._probe_pool is not None and self._probe_pool[0] != workers:
+            self._probe_pool[1].shutdown()
+            self._probe_pool = None
+        if self._probe_pool is None:
+            context = multiprocessing.get_context("fork") if "fork" in multiprocessing.get_all_start_methods() else None
+            self._probe_pool = (workers, ProcessPoolExecutor(workers, mp_context = context, initializer = _init_probe_worker, initargs = (self._worker_copy(),)))
+        return self._probe_pool[1]
+
+    def close(self):
+        """
+        Shuts down the worker pools of the case.
+        """
+        self._executor is not None and self._executor.shutdown()
+        self._probe_pool is not None and self._probe_pool[1].shutdown()
+        self._executor, self._probe_pool = None, None
+
+    def _read_decomposed_field(self, tdir, field, indices = None):
+        """
+        Reads field at tdir from each processor directory of a decomposed case, in parallel if workers > 1,
+        and scatters the processor fields into global cell order. If indices are given only those cells are read.
+        Returns the data and None, or None and the reason the field couldn't be read.
+        """
+        paths = [fieldio.find_field_file(os.path.join(self.path, p, tdir), field) for p in self.mesh.processors]
+        if None in paths:
+            return None, "Could not find field {} of time directory {} in {}.".format(field, tdir, self.mesh.processors[paths.index(None)])
+        ndims = self.field_ndims[field]
+        if indices is None: # Each processor's field goes to the global indices of its cells.
+            targets = [self.mesh.proc_cells[self.mesh.proc_offsets[i]:self.mesh.proc_offsets[i+1]] for i in range(len(paths))]
+            jobs    = [(p, None) for p in paths]
+            n       = len(self.mesh.proc_cells)
+        else: # Only read the processors that have some of the cells, and only at those cells.
+            local   = [(p, pos, loc) for p, (pos, loc) in zip(paths, self.mesh.global_to_local(indices)) if len(pos)]
+            paths   = [p for p, pos, loc in local]
+            targets = [pos for p, pos, loc in local]
+            jobs    = [(p, loc) for p, pos, loc in local]
+            n       = len(indices)
+        results = self._map(_parse_field_job, jobs)
+        data = np.zeros((n,) if ndims == 1 else (n, ndims))
+        for path, target, values in zip(paths, targets, results):
+            if values is None:
+                return None, "Data for field {} in time directory {} was read as None from {}.".format(field, tdir, path)
+            data[target] = values
+        return data, None
+
+    def add_probe(self, field, coord, name = None, color = None, coord_mode = "relative", min_distance = 0.01, index = None, interpolate = False, weights = None):
+        """
+        Adds a probe of field at coord. If the data index of the probe is already known
+        (e.g. from a batch Mesh.coords2indices call) it can be passed as index.
+        If interpolate is set, the probe interpolates the field from the neighbouring cells 
+        instead of taking the value at the nearest cell. Precomputed interpolation weights
+        can be passed as a (cells, weights) pair of arrays.
+        """
         if field not in self.field_names:
             raise ValueError("Unknown field '{}'. Available fields are: {}.".format(field, ", ".join(self.field_names)))
-        new_probe = Probe(self, field, coord, name=name, color=color, coord_mode=coord_mode)
+        new_probe = Probe(self, field, coord, name=name, color=color, coord_mode=coord_mode, index=index, interpolate=interpolate, weights=weights)
         field_probes =[p for p in self.probes if p.field == field]
         d = np.array([np.sqrt((p.coord[0] - new_probe.coord[0])**2 + (p.coord[1] - new_probe.coord[1])**2 + (p.coord[2] - new_probe.coord[2])**2) for p in field_probes])
         if len(d)==0 or min(d)>min_distance:
@@ -236,80 +733,245 @@ class Case:
             pmin = field_probes[imin]
             self.log(f"New probe is too close to existing probe {pmin.name=} of {pmin.field=} at ({pmin.coord[0]}, {pmin.coord[1]}, {pmin.coord[2]}), skipping.")
 
+    def add_probes(self, field, coords, coord_mode = "relative", min_distance = 0.01, interpolate = False):
+        """
+        Adds probes of field at each of the coords in one go. Like add_probe, a probe closer 
+        than min_distance to an existing probe of the field, or to a probe accepted earlier 
+        in the batch, is skipped. The distances are found with a KD-tree, and the data indices 
+        and interpolation weights of all the probes are computed in batch calls.
+        Returns a boolean array marking which of the coords were added as probes.
+        """
+        if field not in self.field_names:
+            raise ValueError("Unknown field '{}'. Available fields are: {}.".format(field, ", ".join(self.field_names)))
+        if len(coords) == 0:
+            return np.zeros(0, dtype=bool)
+        points = np.zeros((len(coords), 3))
+        points[:, :np.shape(coords)[1]] = coords
+        if coord_mode.lower() == "relative":
+            lo = np.array([self.mesh.x_range[0], self.mesh.y_range[0], self.mesh.z_range[0]])
+            hi = np.array([self.mesh.x_range[1], self.mesh.y_range[1], self.mesh.z_range[1]])
+            points = points * (hi - lo) + lo
+            coords = [tuple(p) for p in points]
+
+        accepted = np.ones(len(points), dtype=bool)
+        field_probes = [p for p in self.probes if p.field == field]
+        if field_probes:
+            existing = np.zeros((len(field_probes), 3))
+            for i, p in enumerate(field_probes):
+                existing[i, :len(p.coord)] = p.coord
+            d, _ = cKDTree(existing).query(points)
+            accepted &= d > min_distance
+        # Within the batch, the earlier of two probes closer than min_distance wins, as if they had been added one at a time.
+        for i, j in sorted(cKDTree(points).query_pairs(min_distance)):
+            if accepted[i]:
+                accepted[j] = False
+
+        keep    = np.flatnonzero(accepted)
+        n_field = len(field_probes)
+        # Coordinates with a z-coordinate are mapped in 3D, the rest in 2D, as in Mesh.coord2index.
+        indices = np.zeros(len(keep), dtype=int)
+        in_3d   = points[keep, 2] != 0
+        for mask, ndims in [(~in_3d, 2), (in_3d, 3)]:
+            if mask.any():
+                indices[mask] = self.mesh.coords2indices(points[keep[mask], :ndims])
+        W = self.mesh.interpolation_weights(points[keep, :2]) if interpolate else None
+        colors = [tuple(c) for c in plt.cm.hsv(np.random.rand(len(keep)))]
+        for k, i in enumerate(keep):
+            weights = (W.indices[W.indptr[k]:W.indptr[k+1]], W.data[W.indptr[k]:W.indptr[k+1]]) if interpolate else None
+            self.probes.append(Probe(self, field, coords[i], coord_mode = "absolute", name = "%s_%d" % (field, n_field + k + 1), color = colors[k],
+                                     index = indices[k], weights = weights, verbose = False))
+        self.log("Added {}/{} probes of {}. {} were within {} of another probe.".format(len(keep), len(points), field, len(points) - len(keep), min_distance))
+        return accepted
+
     def get_probe(self, name):
         for p in self.probes:
             if p.name == name:
                 return p
         return None
 
-    def read_probes(self, skip_first = True, tmin = -1, tmax = 100000):
+    def _read_fields(self, tdir, fields, indices = None):
+        """
+        Reads the internal fields of the given fields in time directory tdir. If the time 
+        is only available as an archive, the fields are streamed out of the archive instead.
+        Fields in the field store are read from the store. Decomposed cases are read from the 
+        processor directories. Other full fields are looked up in, and added to, the field cache.
+        indices optionally maps fields to sorted arrays of cell indices. For those fields only 
+        the entries at the indices are parsed, and the cache is bypassed.
+        Returns a dict mapping each field to its data (None if it couldn't be read),
+        and a dict mapping the fields that couldn't be read to the reason why.
+        """
+        indices = indices if indices else {}
+        field_data, errors, keys = {f:None for f in fields}, {}, {}
+        # Fields in the field store are read from there, the rest from the field files.
+        stored = [f for f in fields if self.field_store is not None and self.field_store.has(f, tdir)]
+        for f in stored:
+            field_data[f] = self.field_store.read(f, tdir, indices.get(f))
+        to_parse = [f for f in fields if f not in stored]
+        if self.mesh.processors:
+            for f in to_parse:
+                if f in indices:
+                    field_data[f], msg = self._read_decomposed_field(tdir, f, indices[f])
+                else:
+                    first = fieldio.find_field_file(os.path.join(self.path, self.mesh.processors[0], tdir), f)
+                    keys[f] = (f, tdir, os.stat(first).st_mtime_ns if first else None)
+                    field_data[f], msg = self.field_cache.get(keys[f]), None
+                    if field_data[f] is None:
+                        field_data[f], msg = self._read_decomposed_field(tdir, f)
+                        self.field_cache.put(keys[f], field_data[f])
+                if msg:
+                    errors[f] = msg
+        elif to_parse and tdir in self.time_archives:
+            archive = self.time_archives[tdir]
+            try:
+                mtime = os.stat(archive).st_mtime_ns
+                for f in to_parse:
+                    keys[f] = (f, tdir, mtime)
+                    field_data[f] = self.field_cache.get(keys[f]) if f not in indices else None
+                to_read  = [f for f in to_parse if field_data[f] is None]
+                contents = fieldio.read_archived_fields(archive, tdir, to_read) if to_read else {}
+            except fieldio.READ_ERRORS as e:
+                return field_data, {f:"Could not read archive {}: {}".format(archive, e) for f in to_parse}
+            for f in to_read:
+                if f not in contents:
+                    errors[f] = "Could not find field {} of time directory {} in archive {}.".format(f, tdir, archive)
+                elif f in indices:
+                    field_data[f] = fieldio.parse_internal_field_content(contents[f], indices[f])
+                else:
+                    field_data[f] = fieldio.parse_internal_field_content(contents[f])
+                    self.field_cache.put(keys[f], field_data[f])
+        else:
+            for f in to_parse:
+                field_path = fieldio.find_field_file(os.path.join(self.path, tdir), f)
+                if field_path is None: # Neither the raw nor the zipped file is there
+                    errors[f] = "Could not find raw field file {0} or zipped version {0}.gz.".format(os.path.join(self.path, tdir, f))
+                elif f in indices: # Zipped files are decompressed in memory.
+                    field_data[f] = fieldio.parse_internal_field(field_path, indices[f])
+                else:
+                    keys[f] = (f, tdir, os.stat(field_path).st_mtime_ns)
+                    field_data[f] = self.field_cache.get(keys[f])
+                    if field_data[f] is None:
+                        field_data[f] = fieldio.parse_internal_field(field_path)
+                        self.field_cache.put(keys[f], field_data[f])
+
+        for f in fields:
+            if f not in errors and field_data[f] is None: # The file is corrupted
+                errors[f] = "Data for field {} in time directory {} was read as None.".format(f, tdir)
+        return field_data, errors
+
+    def _read_probe_chunk(self, tdirs, fields, indices, selective = True):
+        """
+        Reads the fields at the sorted probe indices of each field for each of the time directories.
+        Returns a dict mapping each field to an (n_times, n_indices[, ncomp]) array, and a list of
+        (tdir, reason) pairs for the problems found. Unusable time directories are left as NaN.
+        """
+        values = {f:np.full((len(tdirs), len(indices[f])) + ((self.field_ndims[f],) if self.field_ndims[f] > 1 else ()), np.nan) for f in fields}
+        problems = []
+        for i, tdir in enumerate(tdirs):
+            field_data, errors = self._read_fields(tdir, fields, indices if selective else None)
+            problems += [(tdir, msg) for msg in errors.values()]
+            if errors: # If for whatever reason the time directory is unusable, leave the data as NaN.
+                continue
+            for f in fields:
+                data = np.asarray(field_data[f])
+                # Full nonuniform fields are indexed, uniform values are broadcast.
+                values[f][i] = data if selective or data.ndim < values[f].ndim - 1 else data[indices[f]]
+        return values, problems
+
+    def _worker_copy(self):
+        """
+        A lightweight copy of the case for reading in worker processes: no probes, no field cache, no pool.
+        """
+        case = copy(self)
+        case.probes      = []
+        case.probe_sets  = {}
+        case.workers     = 1
+        case.verbosity   = 0
+        case._executor   = None
+        case._probe_pool = None
+        case.field_cache = fieldio.FieldCache(0)
+        return case
+
+    def select_time_dirs(self, tmin = -1, tmax = 100000, skip_first = True, stride = 1, fs = None):
+        """
+        Returns the time directories with tmin <= t <= tmax, skipping the first time directory of 
+        the case if skip_first is set. If a target sample rate fs (in Hz) is given, only the time 
+        nearest to each multiple of 1/fs from the first selected time is kept. Then every 
+        stride'th time is kept. Only the list of times is used, no files are opened.
+        """
+        use = [i for i, tv in enumerate(self.time_vals) if tmin <= tv <= tmax and (not skip_first or i)]
+        if fs and len(use):
+            tv = np.array([self.time_vals[i] for i in use])
+            period = 1. / fs
+            tol = 1e-3 * period # So that a last time written with rounding errors still gets its target.
+            targets = tv[0] + period * np.arange(int((tv[-1] - tv[0] + tol) / period) + 1)
+            right = np.clip(np.searchsorted(tv, targets), 0, len(tv) - 1)
+            left  = np.clip(right - 1, 0, len(tv) - 1)
+            keep  = np.unique(np.where(targets - tv[left] <= tv[right] - targets, left, right))
+            use = [use[k] for k in keep]
+        return [self.time_dirs[i] for i in use[::stride]]
+
+    def read_probes(self, skip_first = True, tmin = -1, tmax = 100000, selective = True, workers = 1, stride = 1, fs = None, tdirs = None):
+        """
+        Reads the probe data for the time directories with tmin <= t <= tmax, optionally 
+        subsampled by stride or to a target sample rate fs, see select_time_dirs.
+        An explicit list of time directories to read can be given as tdirs instead.
+        If selective is set, only the cells of the probes are parsed from each field file.
+        With workers > 1 the time directories are split into chunks that are read by a pool of 
+        worker processes, which only send back the values at the probe indices. The pool is kept
+        for later calls until close() is called.
+        """
         if len(self.probes) == 0:
             self.log("No probes to read.")
             return
 
         with TimedBlock("READING PROBES", self.log):
-            for p in self.probes:
-                p.t = [d for i, d in enumerate(self.time_dirs) if (self.time_vals[i] >= tmin and self.time_vals[i] <= tmax and (not skip_first or i))]
-                p.data = []
-    
-            nt = len(self.probes[0].t)
+            tdirs = list(tdirs) if tdirs is not None else self.select_time_dirs(tmin, tmax, skip_first, stride, fs)
+            nt = len(tdirs)
             self.log("Using {}/{} time directories.".format(nt, len(self.time_dirs)))
-            start_time = time.time()
-            original_time = time.time()
+            fields = list(dict.fromkeys([p.field for p in self.probes]))
+            self.probe_sets = {f:ProbeSet(f, [p for p in self.probes if p.field == f], self.field_ndims[f]) for f in fields}
+            for probe_set in self.probe_sets.values():
+                probe_set.allocate(tdirs)
+            indices = {f:self.probe_sets[f].cells for f in fields}
+
+            # Fields in the field store for all the times are read as one strided slice over time.
+            stored = [f for f in fields if self.field_store is not None and self.field_store.has_all(f, tdirs)]
+            for f in stored:
+                self.log("Reading field {} from the field store.".format(f))
+                self.probe_sets[f].fill(self.field_store.probe(f, indices[f], tdirs))
+            fields = [f for f in fields if f not in stored]
+
             bad_dirs = []
             reasons = []
-            for i, tdir in enumerate(self.probes[0].t):
-                #print("\n{:>8}: ".format(tdir),)
-                field_data = {}
-                for p in self.probes:
-                    if p.field not in field_data: # Field data has not been loaded yet, so try to load it
-                        field_data[p.field] = None
-                        field_path = os.path.join(self.path, tdir, p.field)
-                        zipped = False
-                        if not os.path.isfile(field_path): # The raw file is not there 
-                            # Look for the zipped file.
-                            zipped_path = field_path + ".gz"
-                            if not os.path.isfile(zipped_path): # The zipped file is not there
-                                bad_dirs.append(tdir)
-                                msg = "Could not find raw field file {} or zipped version {}.".format(field_path, zipped_path)
-                                self.log("Warning: " + msg)
-                                reasons.append(msg)
-                            else:
-                                # Found the zipped file, unzip 
-                                zipped = True
-                                os.system("gunzip < {} > {}".format(zipped_path, field_path))
-                                if not os.path.isfile(field_path):
-                                    bad_dirs.append(tdir)
-                                    msg = "Could not find {} after unziping.".format(field_path)
-                                    self.log("Warning: " + msg)
-                                    reasons.append(msg)
-
-                        if tdir not in bad_dirs: # The file should be there, so try to read it:
-                            field_data[p.field] = Ofpp.parse_internal_field(field_path)
-
-                            if field_data[p.field] is None: # The file is corrupted
-                                bad_dirs.append(tdir)
-                                msg = "Data for field {} in time directory {} was read as None.".format(p.field, tdir)
-                                self.log("Warning: " + msg)
-                                reasons.append(msg)
-                                
-                            if zipped: # The file has been unzipped, so remove it.
-                                os.system("rm {}".format(field_path))
-
-                    # Now load the probe with data
-                    if len(p.data) == 0:
-                        p.data = np.zeros((nt, self.field_ndims[p.field]))
-
-                    # If for whatever reason the time directory is unusable, set the data to Nan.
-                    # Otherwise fill it with the actual data.
-                    p.data[i,:] = np.nan if tdir in bad_dirs else field_data[p.field][p.index,:] if self.field_ndims[p.field]>1 else field_data[p.field][p.index]
-                        
-                if time.time() - start_time > 10:
-                    elapsed = time.time() - original_time 
-                    secs_per_timepoint = elapsed / i
-                    secs_remaining = secs_per_timepoint * (nt - i)
-                    self.log("Read {:>6d}/{:>6d} time points in {:>6.1f} secs. {:>6.3f} secs / time point. {:>6.3f} secs remaining). Latest directory read: {}".format(i, len(self.probes[0].t), elapsed, secs_per_timepoint, secs_remaining, tdir))
-                    start_time = time.time()
+            if fields:
+                chunk_size = 1 if workers <= 1 else max(1, min(64, nt // (4 * workers)))
+                jobs = [(tdirs[i:i+chunk_size], fields, indices, selective) for i in range(0, nt, chunk_size)]
+                if workers > 1:
+                    self.log("Reading {} time directories in {} chunks with {} workers.".format(nt, len(jobs), workers))
+                    results = self._probe_executor(workers).map(_read_probe_chunk, jobs)
+                else:
+                    results = (self._read_probe_chunk(*job) for job in jobs)
+
+                start_time = time.time()
+                original_time = time.time()
+                n_read = 0
+                for job, (values, problems) in zip(jobs, results):
+                    chunk = job[0]
+                    for tdir, msg in problems:
+                        bad_dirs.append(tdir)
+                        self.log("Warning: " + msg)
+                        reasons.append(msg)
+                    for f in values:
+                        self.probe_sets[f].fill(values[f], n_read)
+                    n_read += len(chunk)
+
+                    if time.time() - start_time > 10:
+                        elapsed = time.time() - original_time 
+                        secs_per_timepoint = elapsed / n_read
+                        secs_remaining = secs_per_timepoint * (nt - n_read)
+                        self.log("Read {:>6d}/{:>6d} time points in {:>6.1f} secs. {:>6.3f} secs / time point. {:>6.3f} secs remaining). Latest directory read: {}".format(n_read, nt, elapsed, secs_per_timepoint, secs_remaining, chunk[-1]))
+                        start_time = time.time()
+            self.log(str(self.field_cache))
             self.log("Done reading probes. {} bad time directories:".format(len(bad_dirs)))
             for i, (td, msg) in enumerate(zip(bad_dirs, reasons)):
                 self.log("{:>4d}{:>12s}: {}".format(i+1, td, msg))
@@ -318,30 +980,35 @@ class Case:
         with TimedBlock("READFIELD", self.log):
             i_t = np.argmin((t - np.array(self.time_vals))**2)
             self.log("Getting field %s at time nearest to %6.3f: %6.3f." % (field, t, self.time_vals[i_t]))
-            file_path = os.path.join(self.path, self.time_dirs[i_t], field)
-            if not os.path.isfile(file_path):
-                self.log("Could not find field file {}, trying .gz extension.".format(file_path))
-                file_path += ".gz"
-                if not os.path.isfile(file_path):
-                    raise FileExistsError("Could not find field file {}".format(file_path))
-            F = Ofpp.parse_internal_field(file_path)
+            field_data, errors = self._read_fields(self.time_dirs[i_t], [field])
+            if field in errors:
+                raise FileExistsError(errors[field])
+            F = field_data[field]
         return F
         
-    def snapshot_field(self, field, t, verbose = False, grid_size = 0.001, interp_method = "linear"):
+    def snapshot_field(self, field, t, verbose = False, grid_size = 0.001, interp_method = "linear", extent = None):
+        """
+        Interpolates field at the time nearest to t onto a regular grid with spacing grid_size over 
+        extent = (xmin, xmax, ymin, ymax), the range of the cell centers by default. Returns the 
+        interpolated field, NaN outside the mesh, and the grid coordinates. Linear interpolation 
+        uses the cached weights of Mesh.snapshot_weights, other methods go through griddata.
+        """
         F = self.read_field(field,t)
-        X = self.mesh.cell_centers[:,0]
-        Y = self.mesh.cell_centers[:,1]
-        DX = max(X) - min(X)
-        DY = max(Y) - min(Y)
-        XX, YY = np.meshgrid(np.arange(min(X), max(X), grid_size), np.arange(min(Y), max(Y), grid_size))
-
         ndims = self.field_ndims[field]
-        FF = np.zeros((XX.shape[0], XX.shape[1], ndims ))
         if len(F.shape) == 1: #It's a vector
             F = F[:, np.newaxis] # Make it so that it's column accessible.
-            
-        for i in range(ndims):
-            FF[:,:,i] = griddata(self.mesh.cell_centers[:,:2], F[:,i], (XX,YY), method=interp_method)
+
+        if interp_method == "linear":
+            W, xs, ys = self.mesh.snapshot_weights(grid_size, extent)
+            XX, YY = np.meshgrid(xs, ys)
+            FF = W @ F
+            FF[np.diff(W.indptr) == 0] = np.nan
+            FF = FF.reshape(XX.shape + (ndims,))
+        else:
+            XX, YY = np.meshgrid(*self.mesh.snapshot_grid(grid_size, extent))
+            FF = np.zeros((XX.shape[0], XX.shape[1], ndims ))
+            for i in range(ndims):
+                FF[:,:,i] = griddata(self.mesh.cell_centers[:,:2], F[:,i], (XX,YY), method=interp_method)
 
         return np.squeeze(FF), XX, YY
 
@@ -350,8 +1017,7 @@ class Case:
 
         FF = FF if len(FF.shape)==2 else FF[:,:,dim]
 
-        vmin = np.nanmin(FF) if not vmin else np.nanpercentile(FF,float(vmin[:-1])) if vmin[-1] == "%" else float(vmin)
-        vmax = np.nanmax(FF) if not vmax else np.nanpercentile(FF,float(vmax[:-1])) if vmax[-1] == "%" else float(vmax)
+        vmin, vmax = render.color_limits(FF, vmin, vmax)
 
         # Flip upside down so that the Y-axis labeling lines up with the data coordinates.
         plt.matshow(np.flipud(FF),extent=[np.min(XX), np.max(XX), np.min(YY), np.max(YY)], vmin = vmin, vmax = vmax, aspect="equal", fignum=fignum, cmap=eval("plt.cm."+cmap))
@@ -360,11 +1026,11 @@ class Case:
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("--savemesh", help="Create a Mesh object from the current case and save it to file.", action="store_true")
+    parser.add_argument("--savemesh", help="Read the mesh of the current case and (re)write its cache to {}.".format(MESH_CACHE_DIR), action="store_true")
     args = parser.parse_args()
     if args.savemesh:
-        mesh = Mesh(".")
-        mesh.save_to_file("mesh.p")
+        mesh = Mesh(".", use_cache = False)
+        mesh.save_cache(os.path.join(".", MESH_CACHE_DIR), polymesh_fingerprint("."))
         print("ALLDONE")
         
         
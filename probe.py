@@ -11,8 +11,18 @@ parser.add_argument("--ymin",   type = str, help="Minimum y coordinate to use. C
 parser.add_argument("--ymax",   type = str, help="Maximum y coordinate to use. Can be absolute or %% if suffixed with %%.", default="100%")
 parser.add_argument("--tmin",   type = float, help="Minimum time to probe. Output will include t>=tmin. Default = 0",      default=0)
 parser.add_argument("--tmax",   type = float, help="Maximum time to probe. Output will include t< tmax. Default = 100000", default=1000000)
+parser.add_argument("--stride", type = int, help="Only probe every stride'th time directory. Default = 1", default=1)
+parser.add_argument("--fs",     type = float, help="Target sample rate in Hz. Only the time directory nearest to each multiple of 1/fs (from the first time) is probed, e.g. for a quick preview. The files of the skipped directories are never opened.", default=None)
 parser.add_argument("--coords", type = str, help="""Specify the coordinates directly. The trailing arguments in the form "(x_1, y_1) (x_2, y_2) ..." are interpreted as coordinates for the probes. Can be supplied as absolute or relative if suffixed with %%. E.g. (2.1, 40%%) will place a probe at x = 2.1m and y = 40%% of the full height.""", default = None)
+parser.add_argument("--line",   type = str, help="""Sample along a line instead of a grid. Specified as the end points "(x_0, y_0) (x_1, y_1)", absolute or relative as for --coords. The number of points is set by --npoints.""", default = None)
+parser.add_argument("--plane",  type = str, help="""Sample on a plane instead of a grid. Specified as three corners "(x_0, y_0, z_0) (x_1, y_1, z_1) (x_2, y_2, z_2)": the origin, and the ends of the two edges from it, sampled with --nx and --ny points respectively. z can be omitted for 2D cases.""", default = None)
+parser.add_argument("--npoints", type = int, help="Number of points for --line. Default = 101", default=101)
+parser.add_argument("--min_distance", type = float, help="Probes closer than this to another probe are skipped. Default = 0.01, or 0 for --line and --plane.", default=None)
 parser.add_argument("--mock", action="store_true", help="Will setup the probes but will not actually read any data. Coordinates and times will still be written.")
+parser.add_argument("--interpolate", action="store_true", help="Interpolate the field at the probe coordinates by inverse distance weighting of the neighbouring cells, instead of taking the value at the nearest cell.")
+parser.add_argument("--incremental", action="store_true", help="Append to the probe data already in the current directory, only probing the times after the last one stored. The probe coordinates must match.")
+parser.add_argument("--checkpoint", type = int, help="Read and write out the probe data in chunks of this many time directories. Bounds the memory used, and lets a killed job be resumed with --incremental. Default = 200", default=200)
+parser.add_argument("--workers", type = int, help="Number of worker processes used to read the time directories in parallel. Default = 1", default=1)
 args = parser.parse_args()
 print(args)
 
@@ -21,10 +31,10 @@ from datetime import datetime
 sys.path.append(os.getenv("CFDGITPY"))
 from external import Ofpp
 import openfoam as openfoam
-import pickle
+import probedata
 import numpy as np
 
-OF = openfoam.Case()
+OF = openfoam.Case(workers = args.workers)
 
 xrange = OF.mesh.x_range
 yrange = OF.mesh.y_range
@@ -62,15 +72,54 @@ print("yrange: {}".format(yrange))
 x2abs = lambda x: validate_coord(c2abs(x, xrange), xrange)
 y2abs = lambda y: validate_coord(c2abs(y, yrange), yrange)
 
-if args.coords:
-    # parse the coordinates
-    print("Parsing coordinates from: {}".format(args.coords))
+zrange = OF.mesh.z_range
+z2abs = lambda z: validate_coord(c2abs(z, zrange), zrange)
+
+def parse_coords(coords_str, with_z = False):
     coords = []
-    for match in re.finditer("\(([^\)]+)\)", args.coords):
+    for match in re.finditer("\(([^\)]+)\)", coords_str):
         s = match.group(1).split(",")
         if len(s)<2:
             raise ValueError("Malformed coordinate {}".format(match.group(0)))
-        coords.append((x2abs(s[0]), y2abs(s[1])))
+        coords.append((x2abs(s[0]), y2abs(s[1])) + ((z2abs(s[2]) if len(s) > 2 else 0.,) if with_z else ()))
+    return coords
+
+def sample_points(corners, shape):
+    """
+    Evenly spaced points on the line or plane spanned from corners[0] to each of the other corners,
+    with shape[k] points along the edge to corners[k+1]. Returns an (n_points, 3) array,
+    with the last edge varying fastest.
+    """
+    origin = np.array(corners[0])
+    edges  = [np.array(c) - origin for c in corners[1:]]
+    fracs  = np.meshgrid(*[np.linspace(0, 1, n) if n > 1 else np.zeros(1) for n in shape], indexing="ij")
+    points = origin + sum(f[..., np.newaxis] * e for f, e in zip(fracs, edges))
+    return points.reshape((-1, 3))
+
+geometry = None
+if args.line or args.plane:
+    # Lines and planes are stored compactly as their corners and number of points along each edge.
+    if args.line:
+        corners = parse_coords(args.line, with_z = True)
+        if len(corners) != 2:
+            raise ValueError("--line needs 2 end points, got {}.".format(len(corners)))
+        shape = [args.npoints]
+    else:
+        corners = parse_coords(args.plane, with_z = True)
+        if len(corners) != 3:
+            raise ValueError("--plane needs 3 corners, got {}.".format(len(corners)))
+        shape = [args.nx, args.ny]
+    # The corners are stored as given, with shape[k] the number of points along the edge from corners[0]
+    # to corners[k+1]. The points are ordered with the first edge varying fastest, like x does for the
+    # grid: point (i, j) of a plane is probe j*shape[0] + i.
+    geometry = {"mode": "line" if args.line else "plane", "corners": corners, "shape": shape}
+    print("Sampling {} with corners {} and shape {}.".format(geometry["mode"], corners, shape))
+    points = sample_points(corners, shape) if args.line else sample_points([corners[0], corners[2], corners[1]], shape[::-1])
+    coords = [tuple(c) for c in points.tolist()]
+elif args.coords:
+    # parse the coordinates
+    print("Parsing coordinates from: {}".format(args.coords))
+    coords = parse_coords(args.coords)
     print(coords)
 else:
 # Set the coordinates based on nx and ny
@@ -79,29 +128,61 @@ else:
     coords = [(xrange[0] + dx*ix, yrange[0] + dy*iy, 0) for iy in range(args.ny) for ix in range(args.nx)]
 
 print("Probing field {} at {} coordinates.".format(args.fieldname, len(coords)))
-for coord in coords:
-    OF.add_probe(args.fieldname, coord, coord_mode = "absolute")
+min_distance = args.min_distance if args.min_distance is not None else (0 if geometry else 0.01)
+accepted = OF.add_probes(args.fieldname, coords, coord_mode = "absolute", min_distance = min_distance, interpolate = args.interpolate)
+
+if geometry:
+    # Coordinate i of the probes is point geometry["points"][i] of the line or plane.
+    geometry["points"] = np.flatnonzero(accepted).tolist() if not np.all(accepted) else "all"
+
+probe_coords = np.array([p.coord for p in OF.probes], dtype=float)
+meta = {"fields": [args.fieldname], "case": os.path.abspath(OF.path), "interpolate": args.interpolate, "stride": args.stride, "target_fs": args.fs, "geometry": geometry}
+resume = False
+if args.incremental:
+    if not os.path.exists(probedata.PROBE_DATASET_DIR) and all(os.path.exists(f) for f in ["probe.coords.p", "probe.t.p", "probe.data.npy"]):
+        print("Converting the existing probe files to {}.".format(probedata.PROBE_DATASET_DIR))
+        probedata.convert_files("probe.", probedata.PROBE_DATASET_DIR)
+    if os.path.exists(probedata.PROBE_DATASET_DIR):
+        old = probedata.ProbeDataset(probedata.PROBE_DATASET_DIR)
+        if old.coords.shape != probe_coords.shape or not np.allclose(old.coords, probe_coords):
+            print("Coordinates in {} don't match the requested probes. Exiting.".format(probedata.PROBE_DATASET_DIR))
+            exit(1)
+        # Settings that change what the rows hold must match too. Older data without them can't be checked.
+        for key in ["fields", "interpolate", "stride", "target_fs"]:
+            if key in old.meta and old.meta[key] != meta[key]:
+                print("{} was written with {} = {}, but {} was requested. Exiting.".format(probedata.PROBE_DATASET_DIR, key, old.meta[key], meta[key]))
+                exit(1)
+        resume = True
+    else:
+        print("No existing probe data found, probing from scratch.")
+
+# The data is streamed to the dataset one checkpoint at a time, so only one chunk of time points
+# is held in memory, and the dataset can be read while the job is running.
+out = probedata.ProbeDatasetWriter(probedata.PROBE_DATASET_DIR, probe_coords, OF.field_ndims[args.fieldname], meta = meta, resume = resume)
+probe_t = out.times()
+if resume:
+    print("Found {} time points up to t = {} in the existing probe data.".format(len(probe_t), probe_t[-1] if len(probe_t) else None))
 
 if not args.mock:
-    OF.read_probes(tmin = args.tmin, tmax = args.tmax)
-    probe_t      = [float(tstr) for tstr in OF.probes[0].t]
+    # Only probe the times after the last one stored. The times are selected over the whole window
+    # so that a resumed run subsamples the same times as an uninterrupted one would.
+    tlast = probe_t[-1] if len(probe_t) else -np.inf
+    todo  = [d for d in OF.select_time_dirs(args.tmin, args.tmax, stride = args.stride, fs = args.fs) if float(d) > tlast]
+    print("Probing {} new time points.".format(len(todo)))
+    step = args.checkpoint if args.checkpoint > 0 else max(len(todo), 1)
+    for i in range(0, len(todo), step):
+        OF.read_probes(tdirs = todo[i:i+step], workers = args.workers)
+        out.append([float(tstr) for tstr in OF.probe_sets[args.fieldname].t], OF.probe_sets[args.fieldname].data)
+        print("Checkpointed {} time points up to t = {}.".format(len(out), out.times()[-1]))
+    OF.close()
 else:
     print(f"{args.mock=} so no probe data was actually read.")
 
-probe_coords = [p.coord for p in OF.probes]
-with open("probe.coords.p", "wb") as out_file:
-    pickle.dump(probe_coords, out_file)
-
-if not args.mock:
-    with open("probe.t.p", "wb") as out_file:
-        pickle.dump(probe_t, out_file)
-    
-    probe_data   = np.stack([p.data for p in OF.probes], axis=1)
-    assert probe_data.shape[0] == len(probe_t),      f"{probe_data.shape[0]=} <> {len(probe_t)=}."
-    assert probe_data.shape[1] == len(probe_coords), f"{probe_data.shape[1]=} <> {len(probe_coords)=}."    
-    np.save("probe.data.npy", probe_data)
+# Record the sample rate of the output, e.g. for regprobe.py.
+probe_t = out.times()
+fs = 1. / np.median(np.diff(probe_t)) if len(probe_t) > 1 else None
+out.update_meta(fs = fs)
+out.close()
+print("Effective sample rate: {} Hz. Wrote {} time points to {}.".format(fs, len(probe_t), probedata.PROBE_DATASET_DIR))
 
 print("ALLDONE")
-
-
-
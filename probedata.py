@@ -0,0 +1,271 @@
+"""
+Probe datasets, and the appendable .npy files they're streamed to disk with.
+
+A probe dataset is a directory (by default probe.ds, as written by probe.py) holding:
+    meta.json   Format version, field names, source case, sample rate, number of probes and
+                components, and whatever else the writer recorded, e.g. the probe geometry.
+    t.npy       The time of each row, float64.
+    coords.npy  The (n_probes, 2 or 3) probe coordinates.
+    data.npy    The (n_times, n_probes, ndim) probe data.
+The time and data files are appendable .npy files, so ProbeDataset can read a time window and a
+subset of the probes straight from the memory-mapped data, also while the dataset is being written.
+
+NpyAppender writes a standard .npy file whose header is padded to a fixed size, so that the
+shape in the header can be updated in place as rows are appended along the first axis. Memory
+use is bounded by the size of the blocks appended, not by the size of the file. The rows are
+written before the header is updated, so np.load(path) or np.load(path, mmap_mode="r") of a
+file that's still being written always sees whole rows.
+
+Usage:
+    python probedata.py info [probe.ds]            # Prints the metadata and shape of a dataset.
+    python probedata.py convert [probe.] [probe.ds] # Converts <prefix>coords.p, t.p and data.npy files into a dataset.
+
+Example:
+    ds = ProbeDataset("probe.ds")
+    t, data = ds.read(tmin = 10, tmax = 20, probes = [0, 5, 7])
+"""
+import os, json, pickle, struct
+import numpy as np
+from numpy.lib import format as npy_format
+
+PROBE_DATASET_DIR     = "probe.ds"
+PROBE_DATASET_VERSION = 1
+
+# Size of the padded header. Leaves plenty of room for the shape to grow, and is a multiple of
+# 64 bytes so the data stays aligned as np.save would align it.
+HEADER_BYTES = 256
+
+def npy_header(dtype, shape):
+    """
+    Version 1.0 .npy header for a C-ordered array, padded to HEADER_BYTES.
+    """
+    header = repr({"descr": npy_format.dtype_to_descr(np.dtype(dtype)), "fortran_order": False, "shape": tuple(int(n) for n in shape)}).encode("latin1")
+    size = HEADER_BYTES - 10 # Minus the magic string, version and header length.
+    if len(header) + 1 > size:
+        raise ValueError("Shape {} is too long for a {} byte .npy header.".format(shape, HEADER_BYTES))
+    return npy_format.magic(1, 0) + struct.pack("<H", size) + header.ljust(size - 1) + b"\n"
+
+def read_npy_header(path):
+    """
+    Returns the (shape, dtype, data offset) of the .npy file at path.
+    """
+    with open(path, "rb") as f:
+        version = npy_format.read_magic(f)
+        read_header = npy_format.read_array_header_1_0 if version == (1, 0) else npy_format.read_array_header_2_0
+        shape, fortran_order, dtype = read_header(f)
+        if fortran_order:
+            raise ValueError("Can't append to the Fortran ordered array in {}.".format(path))
+        return shape, dtype, f.tell()
+
+class NpyAppender:
+    def __init__(self, path, row_shape, dtype = float, resume = False):
+        """
+        Opens the .npy file at path for appending rows of shape row_shape. If resume is set and the
+        file exists, rows are appended after the ones already in the file, otherwise the file is
+        started afresh. Files written by np.save are rewritten once with a padded header.
+        """
+        self.path      = path
+        self.row_shape = tuple(row_shape)
+        self.dtype     = np.dtype(dtype)
+        self.row_bytes = int(np.prod(self.row_shape)) * self.dtype.itemsize
+        if resume and os.path.exists(path):
+            shape, dtype, offset = read_npy_header(path)
+            if tuple(shape[1:]) != self.row_shape or dtype != self.dtype:
+                raise ValueError("Can't append rows of {} {} to {} which holds {} {}.".format(self.row_shape, self.dtype, path, shape[1:], dtype))
+            if offset != HEADER_BYTES:
+                self._repad(shape[0])
+            self.file   = open(path, "r+b")
+            # Rows beyond the shape in the header (or partially written ones) are dropped.
+            self.n_rows = min(shape[0], (os.path.getsize(path) - HEADER_BYTES) // self.row_bytes if self.row_bytes else shape[0])
+            self.truncate(self.n_rows)
+        else:
+            self.file   = open(path, "w+b")
+            self.n_rows = 0
+            self._write_header()
+
+    def _repad(self, n_rows, block_rows = 1024):
+        data = np.load(self.path, mmap_mode = "r")
+        tmp  = NpyAppender(self.path + ".tmp", self.row_shape, self.dtype)
+        for i in range(0, n_rows, block_rows):
+            tmp.append(data[i:i + block_rows])
+        tmp.close()
+        del data
+        os.replace(self.path + ".tmp", self.path)
+
+    def _write_header(self):
+        self.file.seek(0)
+        self.file.write(npy_header(self.dtype, (self.n_rows,) + self.row_shape))
+        self.file.flush()
+
+    def append(self, rows):
+        rows = np.ascontiguousarray(rows, dtype = self.dtype)
+        if rows.shape[1:] != self.row_shape:
+            raise ValueError("Expected rows of shape {}, got {}.".format(self.row_shape, rows.shape[1:]))
+        self.file.seek(HEADER_BYTES + self.n_rows * self.row_bytes)
+        self.file.write(rows.tobytes())
+        self.file.flush()
+        self.n_rows += len(rows)
+        self._write_header()
+
+    def truncate(self, n_rows):
+        self.n_rows = n_rows
+        self.file.truncate(HEADER_BYTES + n_rows * self.row_bytes)
+        self._write_header()
+
+    def close(self):
+        self.file.close()
+
+    def __len__(self):
+        return self.n_rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def write_json(path, obj):
+    # Written to a temporary file first, so readers never see a half written file.
+    with open(path + ".tmp", "w") as f:
+        json.dump(obj, f, indent = 4)
+    os.replace(path + ".tmp", path)
+
+class ProbeDataset:
+    def __init__(self, path = PROBE_DATASET_DIR):
+        """
+        Opens the probe dataset in the directory path. Only the metadata, times and coordinates are 
+        loaded, the data is memory-mapped.
+        """
+        self.path = path
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            self.meta = json.load(f)
+        if self.meta.get("version") != PROBE_DATASET_VERSION:
+            raise ValueError("Probe dataset {} has version {}, expected {}.".format(path, self.meta.get("version"), PROBE_DATASET_VERSION))
+        self.coords = np.load(os.path.join(path, "coords.npy"))
+        self._set_data(np.load(os.path.join(path, "t.npy")), np.load(os.path.join(path, "data.npy"), mmap_mode = "r"))
+
+    @classmethod
+    def from_files(cls, prefix = "probe."):
+        """
+        Reads the older <prefix>coords.p, <prefix>t.p and <prefix>data.npy files, and <prefix>meta.json 
+        if it exists, as a dataset.
+        """
+        ds = cls.__new__(cls)
+        ds.path = prefix
+        ds.meta = {}
+        if os.path.exists(prefix + "meta.json"):
+            with open(prefix + "meta.json", "r") as f:
+                ds.meta = json.load(f)
+        with open(prefix + "coords.p", "rb") as f:
+            ds.coords = np.array(pickle.load(f, encoding = "latin1"), dtype = float)
+        with open(prefix + "t.p", "rb") as f:
+            t = np.array(pickle.load(f, encoding = "latin1"), dtype = float)
+        ds._set_data(t, np.load(prefix + "data.npy", mmap_mode = "r"))
+        return ds
+
+    def _set_data(self, t, data):
+        # Rows without a time yet, e.g. while the dataset is being written, are left out.
+        n = min(len(t), len(data))
+        self.t, self.data = t[:n], data[:n]
+
+    def __len__(self):
+        return len(self.t)
+
+    @property
+    def fs(self):
+        return self.meta.get("fs")
+
+    def time_slice(self, tmin = None, tmax = None):
+        """
+        Returns the slice of the rows with tmin <= t <= tmax, found by binary search.
+        """
+        start = 0 if tmin is None else np.searchsorted(self.t, tmin, side = "left")
+        stop  = len(self.t) if tmax is None else np.searchsorted(self.t, tmax, side = "right")
+        return slice(int(start), int(stop))
+
+    def read(self, tmin = None, tmax = None, probes = None):
+        """
+        Returns the times and data with tmin <= t <= tmax for the given probes (indices, a boolean mask 
+        or a slice; all of them by default). Only those rows are read from the data file.
+        """
+        rows = self.time_slice(tmin, tmax)
+        data = self.data[rows] if probes is None else self.data[rows][:, probes]
+        return self.t[rows], np.array(data)
+
+class ProbeDatasetWriter:
+    def __init__(self, path, coords, ndim, meta = None, resume = False, dtype = float):
+        """
+        Opens a probe dataset in the directory path for appending data for probes at coords with ndim 
+        components. If resume is set, times are appended to the ones already in the dataset, otherwise 
+        it's started afresh. meta is added to the metadata of the dataset.
+        """
+        self.path   = path
+        self.coords = np.asarray(coords, dtype = float)
+        os.makedirs(path, exist_ok = True)
+        self.meta = {}
+        if resume and os.path.exists(os.path.join(path, "meta.json")):
+            with open(os.path.join(path, "meta.json"), "r") as f:
+                self.meta = json.load(f)
+        self.meta.update(meta or {})
+        self.meta.update({"version": PROBE_DATASET_VERSION, "n_probes": len(self.coords), "ndim": ndim})
+        np.save(os.path.join(path, "coords.npy"), self.coords)
+        self.data = NpyAppender(os.path.join(path, "data.npy"), (len(self.coords), ndim), dtype, resume = resume)
+        self.t    = NpyAppender(os.path.join(path, "t.npy"), (), float, resume = resume)
+        # The data is written before the times, so a job killed in between can leave extra rows.
+        n = min(len(self.t), len(self.data))
+        self.t.truncate(n)
+        self.data.truncate(n)
+        write_json(os.path.join(path, "meta.json"), self.meta)
+
+    def __len__(self):
+        return len(self.t)
+
+    def times(self):
+        return np.load(os.path.join(self.path, "t.npy"))[:len(self)]
+
+    def append(self, t, data):
+        self.data.append(data)
+        self.t.append(np.asarray(t, dtype = float))
+
+    def update_meta(self, **kwargs):
+        self.meta.update(kwargs)
+        write_json(os.path.join(self.path, "meta.json"), self.meta)
+
+    def close(self):
+        self.data.close()
+        self.t.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def convert_files(prefix = "probe.", path = PROBE_DATASET_DIR, block_rows = 1024):
+    """
+    Writes the <prefix>coords.p, <prefix>t.p and <prefix>data.npy files as a probe dataset in path.
+    """
+    old = ProbeDataset.from_files(prefix)
+    with ProbeDatasetWriter(path, old.coords, old.data.shape[2] if old.data.ndim == 3 else 1, meta = old.meta, dtype = old.data.dtype) as ds:
+        for i in range(0, len(old), block_rows):
+            ds.append(old.t[i:i + block_rows], old.data[i:i + block_rows].reshape((-1,) + ds.data.row_shape))
+    return ProbeDataset(path)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Inspects probe datasets, and converts older probe files into them.")
+    parser.add_argument("command", help="What to do.", choices=["info", "convert"])
+    parser.add_argument("paths", nargs="*", help="For info: the dataset, default probe.ds. For convert: the prefix of the probe files and the dataset to write, default probe. and probe.ds.")
+    args = parser.parse_args()
+    print(args)
+
+    if args.command == "info":
+        ds = ProbeDataset(args.paths[0] if args.paths else PROBE_DATASET_DIR)
+        print(json.dumps(ds.meta, indent = 4))
+        print("{} times from {} to {}, data shape {}.".format(len(ds), ds.t[0] if len(ds) else None, ds.t[-1] if len(ds) else None, ds.data.shape))
+    elif args.command == "convert":
+        prefix, path = (args.paths + ["probe.", PROBE_DATASET_DIR][len(args.paths):])[:2]
+        ds = convert_files(prefix, path)
+        print("Wrote {} times of {} probes to {}.".format(len(ds), len(ds.coords), path))
+
+    print("ALLDONE")
@@ -1,87 +1,123 @@
 import argparse
 
-parser = argparse.ArgumentParser(description="Merges all the probe data in the current directory into a single dataset write to the ./merged subdirectory.")
+parser = argparse.ArgumentParser(description="Merges all the probe data in the current directory and its subdirectories into a single dataset written to the ./merged subdirectory.")
+parser.add_argument("--root",    type=str, help="Directory to search for probe segments.", default=".")
+parser.add_argument("--output",  type=str, help="Directory to write the merged dataset to. It's excluded from the search.", default="merged")
+parser.add_argument("--max_gap", type=float, help="Jumps between consecutive times larger than this many median time steps are reported as gaps.", default=1.5)
+parser.add_argument("--block_mb", type=float, help="Size of the blocks of data copied at a time, in MB. Bounds the memory used.", default=256)
 args = parser.parse_args()
 
-import os, sys, re, pickle
+import os, sys
 import os.path as op
 import numpy as np
-import pdb
-
-coords_files = []
-time_files   = []
-data_files   = []
-for root, dirs, files in os.walk("."):
-    coords_files = [op.join(root, f) for f in files if "coords.p" in f]
-    times_files  = [op.join(root, f) for f in files if "t.p" in f]
-    data_files   = [op.join(root, f) for f in files if "data.npy" in f]
-    break
-
-# Open the coords files and make sure they all match
-print(coords_files)
-coords = []
-for f in coords_files:
-    with open(f, "rb") as in_file:
-        coords.append(pickle.load(in_file, encoding="latin1"))
-
-for i in range(len(coords)-1):
-    for j in range(i+1, len(coords)):
-        if coords[i] != coords[j]:
-            print("Coords in {} did not match coords in {}. Exiting.".format(coords_files[i], coords_files[j]))
-            exit(1)
-print("All coordinates files matched.")
-
-times = []
-for f in times_files:
-    with open(f, "rb") as in_file:
-        times.append(pickle.load(in_file, encoding="latin1"))
-
-order = sorted(range(len(times)), key = lambda i: times[i][0])
-print("Merge order: {}".format(order))
-
-t = []
-for i in order:
-    if len(t) == 0:
-        t = times[i]
-        #with open(data_files[i], "rb") as in_file:
-        data = np.load(data_files[i])
-        print("Starting with data from {} ({:.3f} - {:.3f} sec)".format(data_files[i], t[0], t[-1]))
+sys.path.append(os.getenv("CFDGITPY") or op.dirname(op.abspath(__file__)))
+import probedata
+
+# A segment is either a probe dataset directory (e.g. probe.ds written by probe.py), or an older set of
+# <prefix>coords.p, <prefix>t.p and <prefix>data.npy files in the same directory. Segments are searched for recursively.
+output_dir = op.normpath(op.join(args.root, args.output))
+segments = []
+for root, dirs, files in os.walk(args.root):
+    if all(f in files for f in ["meta.json", "t.npy", "coords.npy", "data.npy"]):
+        segments.append({"path": root, "ds": probedata.ProbeDataset(root)})
+        dirs[:] = []
+        continue
+    dirs[:] = sorted(d for d in dirs if op.normpath(op.join(root, d)) != output_dir)
+    for f in sorted(files):
+        if f.endswith("t.p"):
+            prefix = f[:-len("t.p")]
+            if prefix + "coords.p" in files and prefix + "data.npy" in files:
+                segments.append({"path": op.join(root, prefix), "ds": probedata.ProbeDataset.from_files(op.join(root, prefix))})
+print("Found {} probe segments:".format(len(segments)))
+for s in segments:
+    print("    " + s["path"])
+if not segments:
+    print("No probe segments found. Exiting.")
+    exit(1)
+
+# Make sure all the coordinates match
+coords = segments[0]["ds"].coords
+for s in segments[1:]:
+    if s["ds"].coords.shape != coords.shape or not np.allclose(s["ds"].coords, coords):
+        print("Coords in {} did not match coords in {}. Exiting.".format(s["path"], segments[0]["path"]))
+        exit(1)
+print("All coordinates matched.")
+
+# Only the times are loaded, the data is memory-mapped.
+for s in segments:
+    s["t"]    = s["ds"].t
+    s["data"] = s["ds"].data
+    if s["data"].shape[1:] != segments[0]["data"].shape[1:] or s["data"].dtype != segments[0]["data"].dtype:
+        print("Data in {} has shape {} {}, expected {} {}. Exiting.".format(s["path"], s["data"].shape, s["data"].dtype, segments[0]["data"].shape, segments[0]["data"].dtype))
+        exit(1)
+    if np.any(np.diff(s["t"]) <= 0):
+        print("Times in {} are not strictly increasing. Exiting.".format(s["path"]))
+        exit(1)
+segments = [s for s in segments if len(s["t"])]
+if not segments:
+    print("All the probe segments are empty. Exiting.")
+    exit(1)
+
+# Plan the merge: the output has the union of the times of all the segments. Each time is taken from
+# the first segment, in order of the first time, that has it, so a gap in one segment is filled from
+# any other segment that covers it. Times within a thousandth of a time step of each other are the same time.
+segments.sort(key = lambda s: (s["t"][0], -s["t"][-1]))
+print("Merge order: {}".format([s["path"] for s in segments]))
+steps   = np.concatenate([np.diff(s["t"]) for s in segments])
+tol     = 1e-3 * np.median(steps) if len(steps) else 0.
+t_all   = np.concatenate([s["t"] for s in segments])
+seg_all = np.concatenate([np.full(len(s["t"]), k) for k, s in enumerate(segments)])
+row_all = np.concatenate([np.arange(len(s["t"])) for s in segments])
+by_time = np.lexsort((seg_all, t_all))
+same    = np.concatenate([[0], np.cumsum(np.diff(t_all[by_time]) > tol)])
+by_seg  = np.lexsort((seg_all[by_time], same)) # Within each time, the first segment comes first.
+is_first = np.concatenate([[True], np.diff(same[by_seg]) > 0])
+pick    = by_time[by_seg][is_first]
+t, src, rows = t_all[pick], seg_all[pick], row_all[pick]
+
+# Consecutive rows of the same segment are copied together as a run.
+breaks = np.flatnonzero((np.diff(src) != 0) | (np.diff(rows) != 1)) + 1
+runs   = [(int(src[i]), int(rows[i]), int(rows[j-1]) + 1) for i, j in zip(np.concatenate([[0], breaks]), np.concatenate([breaks, [len(t)]]))]
+for k, s in enumerate(segments):
+    s["runs"] = [(i, j) for kr, i, j in runs if kr == k]
+    s["used"] = sum(j - i for i, j in s["runs"])
+    s["duplicates"] = len(s["t"]) - s["used"]
+    if s["used"]:
+        print("Joining {} times from {} in {} run(s): {}. ({} duplicate times dropped)".format(s["used"], s["path"], len(s["runs"]), ", ".join("{:.3f} - {:.3f} sec".format(s["t"][i], s["t"][j-1]) for i, j in s["runs"]), s["duplicates"]))
     else:
-        for istart, tt in enumerate(times[i]):
-            if tt > t[-1]:
-                break
-        print("Joining data from {} starting at index {}. ({:.3f} - {:.3f} sec)".format(data_files[i], istart, times[i][istart], times[i][-1]))
-        new_data = np.load(data_files[i])
-        t += times[i][istart:]
-        data = np.concatenate((data, new_data[istart:]),axis=0)
+        print("Skipping {}, its times ({:.3f} - {:.3f} sec) are all covered by earlier segments.".format(s["path"], s["t"][0], s["t"][-1]))
+used = [s for s in segments if s["used"]]
 
-print("Finished merging {} datasets.".format(len(order)))
 d = np.diff(t)
-print("Output times: {:.3f}  - {:.3f} secs. Intervals = {:.3f} +/- {:.3f} sec. (min: {:.3f}, max: {:.3f})".format(t[0], t[-1], np.mean(d), np.std(d), np.min(d), np.max(d)))
-print("Data shape: {}.".format(data.shape))
-
-print("")
-os.system("mkdir -p merged")
-with open("merged/probe.coords.p", "wb") as out_file:
-    pickle.dump(coords[0], out_file)
-    print("Wrote merged/probe.coords.p")
-
-with open("merged/probe.t.p", "wb") as out_file:
-    pickle.dump(t, out_file)
-    print("Wrote merged/probe.t.p")
-
-np.save("merged/probe.data.npy", data)
-print("Wrote merged/probe.data.npy")
+gaps = []
+if len(d):
+    dt = np.median(d)
+    for i in np.flatnonzero(d > args.max_gap * dt):
+        gaps.append((float(t[i]), float(t[i+1])))
+        print("Warning: gap in the merged times from {:.3f} to {:.3f} sec ({:.1f} time steps).".format(t[i], t[i+1], d[i] / dt))
+    print("Output times: {:.3f}  - {:.3f} secs. Intervals = {:.3f} +/- {:.3f} sec. (min: {:.3f}, max: {:.3f})".format(t[0], t[-1], np.mean(d), np.std(d), np.min(d), np.max(d)))
+
+# The segments are streamed into the output dataset block by block.
+print("Data shape: {}.".format((len(t),) + segments[0]["data"].shape[1:]))
+first = segments[0]["ds"]
+meta  = dict(first.meta)
+meta["fs"] = 1. / np.median(d) if len(d) else None
+meta["merge"] = {"segments": [{"path": s["path"], "t_range": [float(s["t"][0]), float(s["t"][-1])], "used": s["used"], "duplicates": s["duplicates"],
+                                "runs": [[float(s["t"][i]), float(s["t"][j-1])] for i, j in s["runs"]]} for s in segments],
+                 "gaps": gaps}
+for key in ["version", "n_probes", "ndim"]:
+    meta.pop(key, None)
+out_path = op.join(output_dir, probedata.PROBE_DATASET_DIR)
+out = probedata.ProbeDatasetWriter(out_path, coords, first.data.shape[2] if first.data.ndim == 3 else 1, meta = meta, dtype = first.data.dtype)
+row_bytes  = max(first.data[:1].nbytes, 1)
+block_rows = max(int(args.block_mb * 1e6 / row_bytes), 1)
+for k, start, stop in runs:
+    s = segments[k]
+    for i in range(start, stop, block_rows):
+        j = min(i + block_rows, stop)
+        out.append(s["t"][i:j], s["data"][i:j].reshape((j - i,) + out.data.row_shape))
+out.close()
+print("Finished merging {} datasets.".format(len(used)))
+print("Wrote {} time points to {}, with the merge report in its meta.json.".format(len(t), out_path))
 
 print("\nALLDONE.")
-
-        
-        
-
-                     
-
-            
-    
-    
-    
-
@@ -0,0 +1,330 @@
+"""
+SQLite backend for the probe registries (simulations.json, recordings.json, ...).
+
+All the registries in a folder are kept in one database, <jsonpath>/registry.db, with the items
+indexed by registry, name, root and field. Updates are done in transactions, so concurrent
+registrations (e.g. dozens of regprobe.py calls through xargs) are serialized instead of
+overwriting each other. After every update the registry is exported back to its JSON file,
+under the same lock, so code reading the JSON files keeps working. A registry that isn't in
+the database yet is imported from its JSON file the first time it's used.
+
+The probe files of registered items are stored content-addressed under <root>/.blobs, keyed by
+their SHA-256, and hardlinked into <root>/<item root>. Each item records its files and their
+checksums in "files". Files whose size and mtime haven't changed aren't hashed again, so
+re-registering unchanged data only touches the database. Blobs that are no longer referenced
+by any item are removed with the gc command.
+
+Usage:
+    python registry.py find simulations.json [--name NAME] [--root ROOT] [--field FIELD] [--jsonpath PATH]
+    python registry.py import simulations.json [--jsonpath PATH]   # (Re)imports the JSON file, replacing the registry in the database.
+    python registry.py export simulations.json [--jsonpath PATH]   # Rewrites the JSON file from the database.
+    python registry.py gc simulations.json [--dry_run]             # Removes the unreferenced blobs under the root of the registry.
+
+Example:
+    reg = Registry("plumes/registry.db")
+    items = reg.find("simulations.json", field = "S1")
+"""
+import os, json, sqlite3, hashlib, shutil, subprocess, time
+from glob import glob
+
+REGISTRY_DB = "registry.db"
+BLOB_DIR    = ".blobs"
+
+_schema = """
+CREATE TABLE IF NOT EXISTS registries (registry TEXT PRIMARY KEY, root TEXT, extra TEXT);
+CREATE TABLE IF NOT EXISTS items (id INTEGER PRIMARY KEY AUTOINCREMENT, registry TEXT NOT NULL, name TEXT NOT NULL, root TEXT NOT NULL, item TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS items_name_root ON items (registry, name, root);
+CREATE INDEX IF NOT EXISTS items_root ON items (registry, root);
+CREATE TABLE IF NOT EXISTS item_fields (item_id INTEGER NOT NULL, field TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS item_fields_field ON item_fields (field);
+CREATE INDEX IF NOT EXISTS item_fields_item ON item_fields (item_id);
+CREATE TABLE IF NOT EXISTS file_hashes (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, sha256 TEXT);
+"""
+
+def file_sha256(path, block_bytes = 2**24):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_bytes), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def copy_file(src, dst):
+    """
+    Copies src to dst, as a reflink (copy-on-write clone) where the filesystem supports it.
+    """
+    try:
+        subprocess.run(["cp", "--reflink=auto", src, dst], check = True, stderr = subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        shutil.copyfile(src, dst)
+
+def link_file(src, dst):
+    """
+    Hardlinks src at dst, replacing dst atomically. Falls back to a copy if hardlinks aren't possible.
+    """
+    os.makedirs(os.path.dirname(dst), exist_ok = True)
+    tmp = dst + ".tmp{}".format(os.getpid())
+    try:
+        os.link(src, tmp)
+    except OSError: # e.g. across filesystems
+        copy_file(src, tmp)
+    os.replace(tmp, dst)
+
+class Registry:
+    def __init__(self, path, timeout = 600):
+        """
+        Opens (creating if needed) the registry database at path. Writers wait up to timeout
+        seconds for each other.
+        """
+        self.path = path
+        self.db = sqlite3.connect(path, timeout = timeout, isolation_level = None)
+        self.db.execute("PRAGMA busy_timeout = {}".format(int(timeout * 1000)))
+        self.db.executescript(_schema)
+
+    def _write(self, fun):
+        """
+        Runs fun in a write transaction, holding the database lock from the start so that
+        the checks and updates in fun are atomic.
+        """
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            result = fun()
+        except:
+            self.db.execute("ROLLBACK")
+            raise
+        self.db.execute("COMMIT")
+        return result
+
+    def has_registry(self, registry):
+        return self.db.execute("SELECT 1 FROM registries WHERE registry = ?", (registry,)).fetchone() is not None
+
+    def root(self, registry):
+        row = self.db.execute("SELECT root FROM registries WHERE registry = ?", (registry,)).fetchone()
+        if row is None:
+            raise KeyError("Registry {} not found in {}.".format(registry, self.path))
+        return row[0]
+
+    def find(self, registry = None, name = None, root = None, field = None):
+        """
+        Returns the items matching all the given criteria, in the order they were registered.
+        """
+        query, params = "SELECT item FROM items WHERE 1", []
+        for column, value in [("registry", registry), ("name", name), ("root", root)]:
+            if value is not None:
+                query += " AND {} = ?".format(column)
+                params.append(value)
+        if field is not None:
+            query += " AND id IN (SELECT item_id FROM item_fields WHERE field = ?)"
+            params.append(field)
+        return [json.loads(row[0]) for row in self.db.execute(query + " ORDER BY id", params)]
+
+    def _insert(self, registry, item):
+        if "name" not in item: raise ValueError(f"Registry item {item} is missing 'name' field.")
+        if "root" not in item: raise ValueError(f"Registry item {item} is missing 'root' field.")
+        cur = self.db.execute("INSERT INTO items (registry, name, root, item) VALUES (?, ?, ?, ?)", (registry, item["name"], item["root"], json.dumps(item, sort_keys = True)))
+        self.db.executemany("INSERT INTO item_fields (item_id, field) VALUES (?, ?)", [(cur.lastrowid, f) for f in item.get("fields", [])])
+
+    def _delete(self, where, params):
+        ids = [row[0] for row in self.db.execute("SELECT id FROM items WHERE " + where, params)]
+        self.db.executemany("DELETE FROM item_fields WHERE item_id = ?", [(i,) for i in ids])
+        self.db.executemany("DELETE FROM items WHERE id = ?", [(i,) for i in ids])
+        return len(ids)
+
+    def register(self, registry, item, overwrite = False, json_file = None):
+        """
+        Adds item to registry. If an item with the same name and root already exists it's replaced
+        if overwrite is set, otherwise a ValueError is raised and nothing changes.
+        If json_file is given, the registry is exported to it before the lock is released.
+        Returns the items that were replaced.
+        """
+        def update():
+            existing = self.find(registry, name = item["name"], root = item["root"])
+            if existing and not overwrite:
+                raise ValueError("Item with name {} and root {} already exists in {}.".format(item["name"], item["root"], registry))
+            self._delete("registry = ? AND name = ? AND root = ?", (registry, item["name"], item["root"]))
+            self._insert(registry, item)
+            json_file and self._export(registry, json_file)
+            return existing
+        return self._write(update)
+
+    def unregister(self, registry, name = None, root = None, json_file = None):
+        """
+        Removes the items of registry matching the given name and/or root, and optionally exports
+        the registry to json_file. Returns the removed items.
+        """
+        if name is None and root is None:
+            raise ValueError("Specify the name and/or root of the items to unregister.")
+        def update():
+            removed = self.find(registry, name = name, root = root)
+            where, params = "registry = ?", [registry]
+            for column, value in [("name", name), ("root", root)]:
+                if value is not None:
+                    where += " AND {} = ?".format(column)
+                    params.append(value)
+            self._delete(where, params)
+            json_file and self._export(registry, json_file)
+            return removed
+        return self._write(update)
+
+    def import_json(self, json_file, registry = None, replace = True):
+        """
+        Imports the registry in json_file (named after the file by default), replacing any
+        items of the registry already in the database. If replace is not set, registries
+        already in the database are left as they are. Returns the number of items imported.
+        """
+        registry = registry if registry else os.path.basename(json_file)
+        def update():
+            if not replace and self.has_registry(registry):
+                return 0
+            with open(json_file) as f:
+                register = json.load(f)
+            extra = {k:v for k, v in register.items() if k not in ["root", "registry"]}
+            self.db.execute("INSERT OR REPLACE INTO registries (registry, root, extra) VALUES (?, ?, ?)", (registry, register.get("root"), json.dumps(extra)))
+            self._delete("registry = ?", (registry,))
+            for item in register["registry"]:
+                self._insert(registry, item)
+            return len(register["registry"])
+        return self._write(update)
+
+    def ensure_imported(self, json_file, registry = None):
+        """
+        Imports json_file if its registry isn't in the database yet.
+        """
+        n = self.import_json(json_file, registry, replace = False)
+        if n:
+            print("Imported {} items from {} into {}.".format(n, json_file, self.path))
+
+    def _export(self, registry, json_file):
+        row = self.db.execute("SELECT root, extra FROM registries WHERE registry = ?", (registry,)).fetchone()
+        register = json.loads(row[1]) if row and row[1] else {}
+        register["root"] = row[0] if row else None
+        register["registry"] = self.find(registry)
+        # Written to a temporary file first, so readers never see a half written registry.
+        with open(json_file + ".tmp", "w") as f:
+            json.dump(register, f, indent=4, sort_keys=True)
+        os.replace(json_file + ".tmp", json_file)
+
+    def export_json(self, registry, json_file):
+        """
+        Writes registry to json_file in the layout of the original JSON registries.
+        """
+        self._write(lambda: self._export(registry, json_file))
+
+    def file_hash(self, path):
+        """
+        The SHA-256 of the file at path. Cached in the database by path, size and mtime.
+        """
+        path, st = os.path.abspath(path), os.stat(path)
+        row = self.db.execute("SELECT sha256 FROM file_hashes WHERE path = ? AND size = ? AND mtime_ns = ?", (path, st.st_size, st.st_mtime_ns)).fetchone()
+        if row:
+            return row[0]
+        sha256 = file_sha256(path)
+        self._write(lambda: self.db.execute("INSERT OR REPLACE INTO file_hashes (path, size, mtime_ns, sha256) VALUES (?, ?, ?, ?)", (path, st.st_size, st.st_mtime_ns, sha256)))
+        return sha256
+
+    def store_files(self, root, source, dest, pattern = "probe*.*"):
+        """
+        Stores the files in source matching pattern (and the files in matching directories, e.g. 
+        probe.ds) as blobs under root/.blobs, and hardlinks them into root/dest. Blobs that already 
+        exist aren't copied again, and links that already point to the right blob are left alone.
+        Returns a dict mapping the paths of the files relative to source to their checksums.
+        """
+        files = []
+        for path in sorted(glob(os.path.join(source, pattern))):
+            if os.path.isdir(path):
+                files += sorted(os.path.join(d, f) for d, _, fs in os.walk(path) for f in fs)
+            else:
+                files.append(path)
+        manifest, n_new, n_linked = {}, 0, 0
+        for path in files:
+            rel = os.path.relpath(path, source)
+            sha256 = manifest[rel] = self.file_hash(path)
+            blob = os.path.join(root, BLOB_DIR, sha256[:2], sha256)
+            if not os.path.exists(blob):
+                os.makedirs(os.path.dirname(blob), exist_ok = True)
+                tmp = blob + ".tmp{}".format(os.getpid())
+                copy_file(path, tmp)
+                os.chmod(tmp, 0o444) # Blobs are shared by all the links to them, so they mustn't be modified in place.
+                os.replace(tmp, blob)
+                n_new += 1
+            else:
+                os.utime(blob) # Marks the blob as in use, so gc doesn't collect it before the item is registered.
+            target = os.path.join(root, dest, rel)
+            if not (os.path.exists(target) and os.path.samefile(target, blob)):
+                link_file(blob, target)
+                n_linked += 1
+        print("Stored {} files from {} in {}: {} new blobs, {} links updated, {} unchanged.".format(len(files), source, os.path.join(root, dest), n_new, n_linked, len(files) - n_linked))
+        return manifest
+
+    def gc(self, root, min_age_hours = 24, dry_run = False):
+        """
+        Removes the blobs under root/.blobs that aren't referenced by any registered item, together with
+        their links under root. Blobs younger than min_age_hours are kept, as they may belong to a 
+        registration that's still in progress. Returns the number of blobs and bytes removed.
+        """
+        referenced = set(h for item in self.find() for h in item.get("files", {}).values())
+        blob_dir   = os.path.join(root, BLOB_DIR)
+        cutoff     = time.time() - min_age_hours * 3600
+        unused = {}
+        for d, _, fs in os.walk(blob_dir):
+            for f in fs:
+                st = os.stat(os.path.join(d, f))
+                if f not in referenced and st.st_mtime < cutoff:
+                    unused[(st.st_dev, st.st_ino)] = os.path.join(d, f)
+        # Links to the unused blobs are found by inode.
+        links = {key: [] for key in unused}
+        for d, dirs, fs in os.walk(root):
+            dirs[:] = [x for x in dirs if os.path.join(d, x) != blob_dir]
+            for f in fs:
+                st = os.lstat(os.path.join(d, f))
+                if st.st_nlink > 1 and (st.st_dev, st.st_ino) in unused:
+                    links[(st.st_dev, st.st_ino)].append(os.path.join(d, f))
+        n_bytes = 0
+        for key, blob in sorted(unused.items(), key = lambda item: item[1]):
+            # Blobs reused by a registration since the scan have had their mtime refreshed.
+            st = os.stat(blob)
+            if st.st_mtime >= cutoff:
+                unused.pop(key)
+                continue
+            for link in links[key]:
+                print("{} {}".format("Would remove" if dry_run else "Removing", link))
+                dry_run or os.remove(link)
+            print("{} blob {}".format("Would remove" if dry_run else "Removing", blob))
+            dry_run or os.remove(blob)
+            n_bytes += st.st_size
+        return len(unused), n_bytes
+
+    def close(self):
+        self.db.close()
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Queries, imports and exports the probe registries.")
+    parser.add_argument("command", help="What to do.", choices=["find", "import", "export", "gc"])
+    parser.add_argument("registry", help="The registry, named after its json file, e.g. 'simulations.json'.", type=str)
+    parser.add_argument("--name",  help="For find: only items with this name.",  type=str, default=None)
+    parser.add_argument("--root",  help="For find: only items with this root.",  type=str, default=None)
+    parser.add_argument("--field", help="For find: only items with this field.", type=str, default=None)
+    parser.add_argument("--min_age_hours", help="For gc: only remove blobs older than this.", type=float, default=24)
+    parser.add_argument("--dry_run", help="For gc: only list what would be removed.", action="store_true")
+    parser.add_argument("--jsonpath", help="The path to the json files containing the data.", type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "plumes"))
+    args = parser.parse_args()
+    print(args)
+
+    reg = Registry(os.path.join(args.jsonpath, REGISTRY_DB))
+    json_file = os.path.join(args.jsonpath, args.registry)
+    if args.command == "import":
+        print("Imported {} items from {}.".format(reg.import_json(json_file), json_file))
+    elif args.command == "export":
+        reg.export_json(args.registry, json_file)
+        print("Exported {} to {}.".format(args.registry, json_file))
+    elif args.command == "find":
+        reg.ensure_imported(json_file)
+        items = reg.find(args.registry, name = args.name, root = args.root, field = args.field)
+        for item in items:
+            print(item)
+        print("Found {} items.".format(len(items)))
+    elif args.command == "gc":
+        reg.ensure_imported(json_file)
+        n, n_bytes = reg.gc(reg.root(args.registry), args.min_age_hours, args.dry_run)
+        print("{} {} unreferenced blobs ({:.1f} MB).".format("Would remove" if args.dry_run else "Removed", n, n_bytes / 1e6))
+    print("ALLDONE")
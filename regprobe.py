@@ -1,6 +1,8 @@
 import os, sys
 import argparse
-import json
+sys.path.append(os.getenv("CFDGITPY") or os.path.dirname(os.path.abspath(__file__)))
+import registry
+import probedata
 
 parser = argparse.ArgumentParser(description="Register probe data into the appropriate json file. ")
 
@@ -8,7 +10,7 @@ parser = argparse.ArgumentParser(description="Register probe data into the appro
 parser.add_argument("name", help="Name of the case.", type=str)
 parser.add_argument("type", help="Type of the case. Must either end in 'json', or be either 'sim' or 'rec'.", type=str)
 parser.add_argument("dest", help="Destination folder below the 'root' directory in the registry to store the probe files.", type=str)
-parser.add_argument("fs", help="Sample rate in Hz.", type=float)
+parser.add_argument("fs", help="Sample rate in Hz, or 'auto' to use the rate recorded by probe.py in the probe dataset.", type=str)
 parser.add_argument("dims", help="The dims expressed as an array, e.g. '[1.2, 0.5]'.", type=str)
 parser.add_argument("plume_source", help="Source location expressed as an array, e.g. '[0.2, 0.250]'.", type=str)
 parser.add_argument("fields", help="List of fields, comma separated, e.g. 'S1,S2'.")
@@ -16,7 +18,7 @@ parser.add_argument("--source", help="Source folder containing the probe files.
 parser.add_argument("--colour", help="The colour to use.", type=str, default="violet")
 parser.add_argument("--jsonpath", help="The path to the json files containing the data.", type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "plumes"))
 parser.add_argument("--overwrite", help="Whether to overwrite an item if it already exists.", action="store_true", default=False)
-parser.add_argument("--nocopy", action="store_true", help="If set, doesn't actually copy the probe files over. Useful if they've been moved manually.")
+parser.add_argument("--nocopy", action="store_true", help="If set, doesn't actually store the probe files. Useful if they've been moved manually.")
 parser.add_argument("--mock", action="store_true", help="If set, doesn't actually write the new registry.")
 args = parser.parse_args()
 print(args)
@@ -25,14 +27,31 @@ if args.type not in ["sim", "rec"]:
     if not args.type.endswith("json"):
         raise ValueError("type must be 'sim' or 'rec', or be the name of a json file.")
 
-file_name = args.type if args.type.endswith("json") else {"sim": "simulations.json", "rec":"recordings.json"}
+file_name = args.type if args.type.endswith("json") else {"sim": "simulations.json", "rec":"recordings.json"}[args.type]
 reg_file  = os.path.join(args.jsonpath, file_name)
 
-# Registry is formed as args.jsonpath/[simulations.json|recordings.json]
+# Registry is formed as args.jsonpath/[simulations.json|recordings.json], kept in args.jsonpath/registry.db
 print(f"Using registry {reg_file}")
-with open(reg_file) as json_data:
-    register = json.load(json_data)
-print(f"{register.keys()}")
+reg = registry.Registry(os.path.join(args.jsonpath, registry.REGISTRY_DB))
+reg.ensure_imported(reg_file, file_name)
+
+if len(args.source) == 0:
+    args.source = args.name
+
+print("Assuming {} contains probe files.".format(args.source))
+if args.fs == "auto":
+    ds_path = os.path.join(args.source, probedata.PROBE_DATASET_DIR)
+    if os.path.isdir(ds_path):
+        args.fs = probedata.ProbeDataset(ds_path).fs
+    elif os.path.exists(os.path.join(args.source, "probe.meta.json")): # Older probe files.
+        args.fs = probedata.ProbeDataset.from_files(os.path.join(args.source, "probe.")).fs
+    else:
+        raise ValueError(f"fs is 'auto' but there's no {ds_path} with a recorded sample rate. Specify the sample rate explicitly.")
+    if args.fs is None:
+        raise ValueError(f"No sample rate recorded for the probe data in {args.source}. Specify the sample rate explicitly.")
+    print(f"Using the sample rate of {args.fs} Hz recorded with the probe data.")
+args.fs = float(args.fs)
+
 new_item = {"name":args.name,
             "root":args.dest,
             "fs":args.fs,
@@ -43,21 +62,8 @@ new_item = {"name":args.name,
 
 print(f"{new_item=}")
 
-if len(args.source) == 0:
-    args.source = args.name
-
-print("Assuming {} contains probe files.".format(args.source))
-# Check to see if there's a field in the registry with the same name
-already_exists = []
-new_registry = []
-for item in register["registry"]:
-    if "name" not in item: raise ValueError(f"Registry item {item} is missing 'name' field.")
-    if "root" not in item: raise ValueError(f"Registry item {item} is missing 'root' field.")
-    if ((item["name"]==new_item["name"]) and (item["root"] == new_item["root"])):
-        already_exists.append(item)
-    else:
-        new_registry.append(item)
-        
+# Check to see if there's an item in the registry with the same name and root
+already_exists = reg.find(file_name, name = new_item["name"], root = new_item["root"])
 
 print(f"Found {len(already_exists)} items matching new item.")
 if len(already_exists):
@@ -68,7 +74,6 @@ if len(already_exists):
 if len(already_exists):
     if args.overwrite is True:
         print(f"Existing registry item with {args.name=} and {args.dest=} found. Overwriting it.")
-        register["registry"] = new_registry
     else:
         print("Existing registry item found. Aborting.")
         
@@ -77,24 +82,21 @@ if len(already_exists):
 if args.nocopy:
     print("Not copying probe files because --nocopy was set.")
 else:
-    # Make the dest dir: register["root"]/args.dest
-    dest_dir = os.path.join(register["root"], args.dest)
-    cmd = f"mkdir -p {dest_dir}"
-    print(cmd)
-    os.system(cmd)
-    
-    # Copy the files over: from args.source 
-    cmd = f"cp {args.source}/probe*.* {dest_dir}"
-    print(cmd)
-    os.system(cmd)
+    # The probe files (the probe dataset directory, and any older probe files) are stored content-addressed 
+    # under the registry root and hardlinked into the dest dir, so unchanged data isn't copied again.
+    new_item["files"] = reg.store_files(reg.root(file_name), args.source, args.dest)
     
 print("Inserting new item:")
 print(new_item)
-register["registry"].append(new_item)
 
 if not args.mock:
-    with open(reg_file, "w") as json_data:
-        json.dump(register, json_data, indent=4, sort_keys=True)
+    # Checks again for an existing item and inserts the new one atomically, in case another
+    # job registered the same item in the meantime.
+    try:
+        reg.register(file_name, new_item, overwrite = args.overwrite, json_file = reg_file)
+    except ValueError as e:
+        print(f"{e} Aborting.")
+        exit(1)
     print(f"Wrote registry to {reg_file=}.")
 else:
     print(f"{args.mock=} so did not update registry.")
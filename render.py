@@ -0,0 +1,90 @@
+"""
+Direct raster rendering of snapshots, without going through a matplotlib figure.
+
+A snapshot (as returned by Case.snapshot_field) is scaled to [vmin, vmax], mapped through the
+lookup table of a colormap, and written as a PNG with one pixel per grid point (or scale x scale
+pixels with --scale). The rows are flipped like the np.flipud in Case.plot_field, so the top row
+of the image is the largest y. Values below vmin and above vmax take the first and last colors
+of the colormap, as in matplotlib, and NaNs (outside the mesh) take nan_color.
+
+Usage:
+    python render.py snapshot.p out.png [--vmin 1%] [--vmax 99%] [--cmap jet] # Renders a snapshot pickled by ofsnapshot.py --extension p.
+
+Example:
+    FF, XX, YY = OF.snapshot_field("S1", 10.0)
+    render.write_png("S1.png", render.render(FF, *render.color_limits(FF, "1%", "99%"), lut = render.colormap_lut("gray")))
+"""
+import struct, zlib
+import numpy as np
+
+def color_limits(FF, vmin = None, vmax = None):
+    """
+    Resolves vmin and vmax the way Case.plot_field does: None (or empty) for the min/max of FF,
+    a string ending in % for a percentile of FF, and a number otherwise.
+    """
+    vmin = np.nanmin(FF) if not vmin else np.nanpercentile(FF,float(vmin[:-1])) if str(vmin)[-1] == "%" else float(vmin)
+    vmax = np.nanmax(FF) if not vmax else np.nanpercentile(FF,float(vmax[:-1])) if str(vmax)[-1] == "%" else float(vmax)
+    return vmin, vmax
+
+def colormap_lut(cmap = "jet", n = 256):
+    """
+    The (n, 3) uint8 RGB lookup table of the matplotlib colormap named cmap. Only the colormap
+    registry is used, no figures are created.
+    """
+    from matplotlib import colormaps
+    return colormaps[cmap].resampled(n)(np.arange(n), bytes = True)[:,:3]
+
+def render(FF, vmin, vmax, lut, nan_color = (255, 255, 255), scale = 1):
+    """
+    Maps the 2D array FF to an (ny*scale, nx*scale, 3) uint8 RGB image through lut, with vmin and
+    vmax at the first and last colors. The rows are flipped so that the top row is the largest y.
+    """
+    FF = np.flipud(np.asarray(FF, dtype=float))
+    # Same binning as matplotlib: [vmin, vmax] is split into len(lut) equal bins, and values outside it are clipped.
+    x = (FF - vmin) / (vmax - vmin) if vmax > vmin else np.zeros_like(FF)
+    ind = np.clip(np.floor(np.nan_to_num(x) * len(lut)), 0, len(lut) - 1).astype(np.intp)
+    image = lut[ind]
+    image[np.isnan(FF)] = nan_color
+    if scale > 1:
+        image = np.repeat(np.repeat(image, scale, axis=0), scale, axis=1)
+    return image
+
+def png_chunk(kind, data):
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+def encode_png(image, level = 6):
+    """
+    Encodes an (height, width, 3) RGB or (height, width, 4) RGBA uint8 image as PNG bytes.
+    """
+    image = np.ascontiguousarray(image, dtype=np.uint8)
+    height, width, channels = image.shape
+    color_type = {3: 2, 4: 6}[channels]
+    # Each row is prefixed with its filter type, 0 (none).
+    raw = np.zeros((height, 1 + width * channels), dtype=np.uint8)
+    raw[:,1:] = image.reshape(height, -1)
+    return (b"\x89PNG\r\n\x1a\n"
+            + png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0))
+            + png_chunk(b"IDAT", zlib.compress(raw.tobytes(), level))
+            + png_chunk(b"IEND", b""))
+
+def write_png(path, image, level = 6):
+    with open(path, "wb") as f:
+        f.write(encode_png(image, level))
+
+if __name__ == "__main__":
+    import argparse, pickle
+    parser = argparse.ArgumentParser(description="Renders a pickled snapshot array to a PNG.")
+    parser.add_argument("input",  help="Pickled 2D array, as written by ofsnapshot.py --extension p.")
+    parser.add_argument("output", help="PNG file to write.")
+    parser.add_argument("--vmin", type = str, help="Minimum value to plot.", default="1%")
+    parser.add_argument("--vmax", type = str, help="Maximum value to plot.", default="99%")
+    parser.add_argument("--cmap", type = str, help="Colormap to use.", default="jet")
+    parser.add_argument("--scale", type = int, help="Each grid point is drawn as scale x scale pixels.", default=1)
+    args = parser.parse_args()
+    print(args)
+
+    with open(args.input, "rb") as f:
+        FF = pickle.load(f)
+    write_png(args.output, render(FF, *color_limits(FF, args.vmin, args.vmax), lut = colormap_lut(args.cmap), scale = args.scale))
+    print("Wrote {}.".format(args.output))
+    print("ALLDONE")
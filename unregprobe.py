@@ -1,7 +1,5 @@
 import os, sys
 import argparse
-import json
-from copy import deepcopy
 
 parser = argparse.ArgumentParser(description="Unregister probe data into the appropriate json file.")
 parser.add_argument("root", help="Unregister if root matches this.", type=str)
@@ -11,23 +9,21 @@ parser.add_argument("--unregister", help="Whether to actually unregister.", acti
 args = parser.parse_args()
 print(args)
 
-print(f"Using registry {args.jsonpath}")
-with open(args.jsonpath) as json_data:
-    register = json.load(json_data)
+sys.path.append(os.getenv("CFDGITPY") or os.path.dirname(os.path.abspath(__file__)))
+import registry
 
-print(f"Loaded registry, containing {len(register['registry'])} items.")
-new_register = deepcopy(register)
-new_register["registry"] = []
+# The registry is kept in registry.db next to the json file, which is exported from it after every update.
+print(f"Using registry {args.jsonpath}")
+reg_name = os.path.basename(args.jsonpath)
+reg = registry.Registry(os.path.join(os.path.dirname(os.path.abspath(args.jsonpath)), registry.REGISTRY_DB))
+reg.ensure_imported(args.jsonpath, reg_name)
 
-for item in register["registry"]:
-    if args.root == item["root"]:
-        print(f"Would remove {item}.")
-    else:
-        new_register["registry"].append(item)
+print(f"Loaded registry, containing {len(reg.find(reg_name))} items.")
+for item in reg.find(reg_name, root = args.root):
+    print(f"Would remove {item}.")
 
 if args.unregister:
-    with open(args.jsonpath, "w") as json_data:
-        json.dump(new_register, json_data, indent=4, sort_keys=True)
-    print(f"Wrote new register, containing {len(new_register['registry'])} items.")
+    removed = reg.unregister(reg_name, root = args.root, json_file = args.jsonpath)
+    print(f"Removed {len(removed)} items. Wrote new register, containing {len(reg.find(reg_name))} items.")
 
 print("ALLDONE.")
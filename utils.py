@@ -1,4 +1,5 @@
 import os, sys, time, re
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
 class TimedBlock():
@@ -35,4 +36,34 @@ def get_numerical_files(case_path = ".", extension = ".tar.gz"):
     time_vals  = [time_vals[i] for i in ind]
     time_files = [time_files[i] for i in ind]
     return time_vals, time_files
-    
+
+def get_time_sources(case_path = ".", extension = ".tar.gz"):
+    """
+    Like get_numerical_directories, but also includes times that are only available as 
+    <time><extension> archives, e.g. after running ziptimes.py --delete.
+    Returns the sorted time values and time directory names, and a dict mapping 
+    the time directories that only exist as archives to their archive paths.
+    """
+    dir_vals, dir_names = get_numerical_directories(case_path = case_path)
+    arc_vals, arc_files = get_numerical_files(case_path = case_path, extension = extension)
+    sources  = dict(zip(dir_names, dir_vals))
+    archives = {}
+    for v, f in zip(arc_vals, arc_files):
+        d = f[:-len(extension)]
+        if d not in sources:
+            sources[d]  = v
+            archives[d] = os.path.join(case_path, f)
+    time_dirs = sorted(sources, key = sources.get)
+    time_vals = [sources[d] for d in time_dirs]
+    return time_vals, time_dirs, archives
+
+def parallel_map(fun, items, workers = 1):
+    """
+    Maps fun over items, in a pool of worker processes if workers > 1. 
+    fun must be picklable, i.e. defined at module level. Results are in the order of items.
+    """
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        return list(map(fun, items))
+    with ProcessPoolExecutor(min(workers, len(items))) as executor:
+        return list(executor.map(fun, items))